@@ -0,0 +1,86 @@
+"""
+CHAMA Load Balancer — Metrics bookkeeping benchmark
+Measures how many proxied requests per second the LB's per-request metrics
+bookkeeping can sustain across N threads, comparing the old global-lock
+counters with the striped CounterSet now used by load_balancer.py. Each run
+is measured twice: with long-lived threads, and with a fresh thread per
+request as Flask's threaded server does.
+
+    python bench_metrics.py
+"""
+import threading
+import time
+from collections import defaultdict
+
+from load_balancer import CounterSet
+
+THREADS  = [1, 4, 8, 16]
+REQUESTS = 200000       # per run, split across the threads
+SHORT_LIVED_REQUESTS = 20000    # per run with a thread per request
+ROUTES   = [("member", "/members"), ("loan", "/loans"), ("report", "/reports")]
+
+class GlobalLockMetrics:
+    """The pre-CounterSet bookkeeping: one module lock taken twice per request."""
+
+    def __init__(self):
+        self.lock    = threading.Lock()
+        self.metrics = {"total_requests": 0, "successful": 0, "failed": 0,
+                        "requests_per_svc": defaultdict(int)}
+
+    def record(self, svc, route, status):
+        with self.lock:
+            self.metrics["total_requests"] += 1
+        with self.lock:
+            self.metrics["requests_per_svc"][svc] += 1
+            if status < 400:
+                self.metrics["successful"] += 1
+            else:
+                self.metrics["failed"] += 1
+
+class ShardedMetrics:
+    def __init__(self):
+        self.counts = CounterSet()
+
+    def record(self, svc, route, status):
+        self.counts.inc(("proxied", svc, route, status))
+
+def run(impl, threads, short_lived=False):
+    per_thread = (SHORT_LIVED_REQUESTS if short_lived else REQUESTS) // threads
+    barrier    = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        barrier.wait()
+        for i in range(per_thread):
+            svc, route = ROUTES[(i + offset) % len(ROUTES)]
+            status     = 200 if i % 10 else 503
+            if short_lived:
+                request = threading.Thread(target=impl.record, args=(svc, route, status))
+                request.start()
+                request.join()
+            else:
+                impl.record(svc, route, status)
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+def main():
+    for short_lived in (False, True):
+        print("=" * 55)
+        print(f"  Metrics bookkeeping throughput, "
+              f"{'thread per request' if short_lived else 'long-lived threads'}")
+        print("=" * 55)
+        print(f"  {'threads':>8} {'global lock':>14} {'CounterSet':>14} {'speedup':>9}")
+        for threads in THREADS:
+            old = max(run(GlobalLockMetrics(), threads, short_lived) for _ in range(3))
+            new = max(run(ShardedMetrics(), threads, short_lived) for _ in range(3))
+            print(f"  {threads:>8} {old:>12,.0f}/s {new:>12,.0f}/s {new / old:>8.2f}x")
+    print("=" * 55)
+
+if __name__ == "__main__":
+    main()
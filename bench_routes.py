@@ -0,0 +1,52 @@
+"""
+CHAMA Load Balancer — Route lookup microbenchmark
+Compares the compiled RouteIndex trie with the old linear startswith scan
+as the number of registered routes grows.
+
+    python bench_routes.py
+"""
+import random
+import timeit
+
+from load_balancer import RouteIndex, SERVICE_ROUTES
+
+ROUTE_COUNTS = [6, 60, 600, 6000]
+LOOKUPS      = 20000
+
+def linear_lookup(service_routes, path):
+    for svc, routes in service_routes.items():
+        for route in routes:
+            if path.startswith(route):
+                return svc, route
+    return None
+
+def make_routes(n):
+    """The real table plus synthetic per-tenant prefixes up to n routes."""
+    routes = {svc: list(prefixes) for svc, prefixes in SERVICE_ROUTES.items()}
+    names  = list(routes)
+    i = 0
+    while sum(len(r) for r in routes.values()) < n:
+        routes[names[i % len(names)]].insert(0, f"/tenant-{i}/api")
+        i += 1
+    return routes
+
+def main():
+    rng   = random.Random(42)
+    paths = [rng.choice(["/members/17", "/contributions/summary", "/loans/summary",
+                         "/reports/financial-summary", "/portfolio", "/unknown/path"])
+             for _ in range(LOOKUPS)]
+
+    print("=" * 55)
+    print(f"  Route lookup cost, {LOOKUPS} lookups per run (ns/lookup)")
+    print("=" * 55)
+    print(f"  {'routes':>8} {'trie':>12} {'linear scan':>14}")
+    for n in ROUTE_COUNTS:
+        table = make_routes(n)
+        index = RouteIndex(table)
+        trie   = min(timeit.repeat(lambda: [index.lookup(p) for p in paths], number=1, repeat=5))
+        linear = min(timeit.repeat(lambda: [linear_lookup(table, p) for p in paths], number=1, repeat=5))
+        print(f"  {n:>8} {trie / LOOKUPS * 1e9:>12.0f} {linear / LOOKUPS * 1e9:>14.0f}")
+    print("=" * 55)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,45 @@
 """
 CHAMA Load Balancer — Port 5000
-Round-robin load balancer that distributes requests across all microservices.
+Load balancer that distributes requests across all microservices, with a
+per-service choice of balancing strategy (round-robin by default).
+
+Run with --async to serve from an asyncio event loop instead of Flask.
 """
 from flask import Flask, jsonify, request, Response
+from werkzeug.exceptions import HTTPException
+from werkzeug.serving import make_server
 import urllib.request
 import urllib.error
+import argparse
+import asyncio
+import base64
+import http.client
+import ipaddress
+import itertools
+import bisect
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
+import math
+import mmap
+import os
+import random
+import re
+import select
+import signal
+import socket
+import struct
 import time
 import threading
+import uuid
+import zlib
+from array import array
 from datetime import datetime
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
 
 app = Flask(__name__)
 
@@ -33,60 +63,2152 @@ SERVICE_ROUTES = {
 }
 
 # ─── Metrics ───────────────────────────────────────────────────
-metrics = {
-    "total_requests":   0,
-    "successful":       0,
-    "failed":           0,
-    "requests_per_svc": defaultdict(int),
-    "response_times":   defaultdict(list),
-    "start_time":       datetime.now().isoformat()
-}
+COUNTER_STRIPES = 31     # prime, so thread idents spread evenly
+
+class CounterSet:
+    """Monotonic counters striped by thread.
+
+    inc() updates one of COUNTER_STRIPES dicts picked from the calling
+    thread's ident, each behind its own lock, so concurrent requests rarely
+    meet on a lock and no update is lost. Stripes are fixed, so short-lived
+    threads (Flask spawns one per connection) cost nothing extra;
+    snapshot() merges them."""
+
+    def __init__(self):
+        self._stripes = [(threading.Lock(), defaultdict(int)) for _ in range(COUNTER_STRIPES)]
+
+    def inc(self, key, n=1):
+        lock, counts = self._stripes[threading.get_ident() % COUNTER_STRIPES]
+        with lock:
+            counts[key] += n
+
+    def snapshot(self):
+        totals = defaultdict(int)
+        for lock, counts in self._stripes:
+            with lock:
+                items = list(counts.items())
+            for key, n in items:
+                totals[key] += n
+        return totals
+
+# Keys: ("proxied", service, route, status) and ("unrouted",)
+request_counts = CounterSet()
+START_TIME     = datetime.now().isoformat()
 lock = threading.Lock()
 
-def get_next_instance(service_name):
-    """Round-robin selection"""
+# ─── Latency histograms ────────────────────────────────────────
+HIST_SLOT_SECONDS = 10
+HIST_SLOTS        = 30      # ring of 10s slots → 5 minutes of history
+HIST_MIN_MS       = 0.05
+HIST_GROWTH       = 1.08    # bucket width ~8%, so percentiles are within ~4%
+HIST_BUCKETS      = 200     # top bucket starts near 230s; slower samples land in it
+LATENCY_WINDOWS   = {"1m": 60, "5m": 300}
+
+class LatencyHistogram:
+    """Fixed-memory, log-bucketed latency histogram over a sliding window.
+
+    Samples go into the slot for the current HIST_SLOT_SECONDS epoch; a slot
+    is reset when the ring wraps around to it, so memory never grows."""
+
+    def __init__(self):
+        self._slots = [None] * HIST_SLOTS      # [epoch, counts, max_ms]
+        self._lock  = threading.Lock()
+
+    @staticmethod
+    def bucket_for(ms):
+        if ms <= HIST_MIN_MS:
+            return 0
+        return min(int(math.log(ms / HIST_MIN_MS, HIST_GROWTH)), HIST_BUCKETS - 1)
+
+    @staticmethod
+    def bucket_value(idx):
+        return HIST_MIN_MS * HIST_GROWTH ** (idx + 0.5)
+
+    def record(self, ms):
+        epoch = int(time.time() // HIST_SLOT_SECONDS)
+        idx   = self.bucket_for(ms)
+        with self._lock:
+            slot = self._slots[epoch % HIST_SLOTS]
+            if slot is None or slot[0] != epoch:
+                slot = self._slots[epoch % HIST_SLOTS] = [epoch, array("L", [0]) * HIST_BUCKETS, 0.0]
+            slot[1][idx] += 1
+            if ms > slot[2]:
+                slot[2] = ms
+
+    def merged(self, seconds):
+        """Bucket counts and max over the last `seconds`: (counts, max_ms)."""
+        now_epoch = int(time.time() // HIST_SLOT_SECONDS)
+        oldest    = now_epoch - max(1, math.ceil(seconds / HIST_SLOT_SECONDS)) + 1
+        counts    = [0] * HIST_BUCKETS
+        max_ms    = 0.0
+        with self._lock:
+            for slot in self._slots:
+                if slot is None or slot[0] < oldest:
+                    continue
+                for i, c in enumerate(slot[1]):
+                    if c:
+                        counts[i] += c
+                max_ms = max(max_ms, slot[2])
+        return counts, max_ms
+
+    def summary(self, seconds):
+        return self.summarize(*self.merged(seconds))
+
+    @classmethod
+    def summarize(cls, counts, max_ms):
+        total = sum(counts)
+        if not total:
+            return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+        result, seen, targets = {"count": total}, 0, [("p50", 0.50), ("p95", 0.95), ("p99", 0.99)]
+        for i, c in enumerate(counts):
+            seen += c
+            while targets and seen >= targets[0][1] * total:
+                result[targets.pop(0)[0]] = round(min(cls.bucket_value(i), max_ms), 2)
+            if not targets:
+                break
+        result["max"] = round(max_ms, 2)
+        return result
+
+    def windows(self):
+        return {name: self.summary(seconds) for name, seconds in LATENCY_WINDOWS.items()}
+
+latency_by_service = {}
+latency_by_route   = {}
+
+def get_histogram(table, key):
+    hist = table.get(key)
+    if hist is None:
+        with lock:
+            hist = table.setdefault(key, LatencyHistogram())
+    return hist
+
+def latency_windows(kind):
+    """{key: {window: summary}} for kind "services" or "routes"; in
+    multi-worker mode the buckets of every worker are merged first."""
+    if shared_regions is not None:
+        return shared_latency_windows(kind)
+    table = latency_by_service if kind == "services" else latency_by_route
+    return {k: h.windows() for k, h in list(table.items())}
+
+def latency_payload():
+    return {"windows":    list(LATENCY_WINDOWS),
+            "services":   latency_windows("services"),
+            "routes":     latency_windows("routes")}
+
+# ─── Response cache ────────────────────────────────────────────
+# Read-heavy summary routes are served from an in-LB LRU cache for a short
+# per-route TTL. Any POST/PUT/DELETE to a service drops that service's
+# cached GETs, and upstream/client Cache-Control directives are respected.
+# Entries are keyed by the caller's identity as well as path and query, so
+# one chama's summary is never served to another, and a request carrying
+# Authorization is only stored when the upstream marks the answer public.
+CACHE_TTLS = {                      # exact path → seconds
+    "/contributions/summary":     5,
+    "/loans/summary":             5,
+    "/reports/financial-summary": 10,
+    "/portfolio":                 10,
+}
+CACHE_MAX_BYTES       = 32 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+WRITE_METHODS         = ("POST", "PUT", "DELETE")
+
+class ResponseCache:
+    """Byte-bounded LRU of (status, content type, body) keyed by path, query
+    and identity."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes   = max_bytes
+        self._entries    = OrderedDict()    # key → (expires, svc, status, ctype, data)
+        self._by_service = defaultdict(set)
+        self._bytes      = 0
+        self._lock       = threading.Lock()
+        self.counters    = defaultdict(int)
+
+    def _drop(self, key):
+        _, svc, _, _, data = self._entries.pop(key)
+        self._by_service[svc].discard(key)
+        self._bytes -= len(data)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._drop(key)
+                self.counters["expired"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[2:]
+
+    def put(self, key, svc, ttl, status, content_type, data):
+        if len(data) > CACHE_MAX_ENTRY_BYTES:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, svc, status, content_type, data)
+            self._by_service[svc].add(key)
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def invalidate_service(self, svc):
+        with self._lock:
+            keys = list(self._by_service[svc])
+            for key in keys:
+                self._drop(key)
+            self.counters["invalidations"] += len(keys)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes,
+                    "max_bytes": self.max_bytes, **self.counters}
+
+response_cache = ResponseCache()
+
+def _cache_directives(value):
+    directives = {}
+    for part in (value or "").lower().split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name] = arg.strip('" ')
+    return directives
+
+def request_identity(authorization, claims):
+    """Whom a response to this request may be shared with: the verified
+    claims forwarded upstream, a digest of an unverified Authorization
+    header, or None for anonymous requests."""
+    forwarded = claim_headers(claims) if claims else {}
+    if forwarded:
+        return tuple(sorted(forwarded.items()))
+    if authorization:
+        return hashlib.sha256(authorization.encode()).hexdigest()
+    return None
+
+def cache_key(method, path, query, identity):
+    """Key to look up/store this request under, or None if not cacheable."""
+    if method != "GET" or path not in CACHE_TTLS:
+        return None
+    return (path, query, identity)
+
+def cache_lookup(key, headers):
+    """`headers` are the client's request headers with lower-case names."""
+    request_cc = _cache_directives(headers.get("cache-control"))
+    if key is None or "no-cache" in request_cc or "no-store" in request_cc:
+        return None
+    return response_cache.get(key)
+
+def cache_store(key, svc_name, headers, status, resp_headers, data):
+    if (key is None or status != 200 or not isinstance(data, bytes)
+            or header_value(resp_headers, "Content-Encoding")):
+        return
+    if "authorization" in headers and "public" not in _cache_directives(
+            resp_headers.get("Cache-Control")):
+        return
+    ttl = CACHE_TTLS[key[0]]
+    for cc in (_cache_directives(headers.get("cache-control")),
+               _cache_directives(resp_headers.get("Cache-Control"))):
+        if "no-store" in cc or "private" in cc:
+            return
+        if cc.get("max-age", "").isdigit():
+            ttl = min(ttl, int(cc["max-age"]))
+    if ttl > 0:
+        response_cache.put(key, svc_name, ttl, status,
+                           resp_headers.get("Content-Type", "application/json"), data)
+
+def cached_response_headers(svc_name):
+    headers = lb_headers(svc_name, 0.0)
+    headers["X-Cache"] = "HIT"
+    return headers
+
+# ─── Request coalescing ────────────────────────────────────────
+# Concurrent identical GETs (same service, path, query and caller identity)
+# share a single upstream call. A follower waits on the leader for as long
+# as its own deadline allows, so a slow 30 s report is not re-requested by
+# every waiter part way through. Streamed bodies cannot be replayed, so
+# waiters on a streamed response fall back to their own upstream call.
+COALESCE_MAX_WAITERS  = 200     # followers per in-flight call before bypassing
+coalesce_stats        = CounterSet()
+
+def _shareable(result):
+    # Upstream-encoded bodies depend on the leader's Accept-Encoding.
+    return (result is not None and isinstance(result[1], bytes)
+            and not header_value(result[3], "Content-Encoding"))
+
+class _Flight:
+    __slots__ = ("done", "result", "waiters")
+
+    def __init__(self):
+        self.done    = threading.Event()
+        self.result  = None
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self, max_waiters=COALESCE_MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self._flights    = {}
+        self._lock       = threading.Lock()
+
+    def do(self, key, fn, deadline=None):
+        """Run fn() once per key among concurrent callers; returns
+        (result, shared) where shared is True for followers. A follower
+        waits for the leader until its own deadline."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                leader = True
+            elif flight.waiters >= self.max_waiters:
+                coalesce_stats.inc("overflow")
+                flight, leader = None, False
+            else:
+                flight.waiters += 1
+                coalesce_stats.inc("coalesced")
+                leader = False
+        if flight is None:
+            return fn(), False
+        if leader:
+            try:
+                flight.result = fn()
+                return flight.result, False
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                coalesce_stats.inc("upstream_calls")
+                flight.done.set()
+        if flight.done.wait(max(time_left(deadline), 0)) and _shareable(flight.result):
+            return flight.result, True
+        coalesce_stats.inc("fallbacks")
+        return fn(), False
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines on the asyncio engine's event loop."""
+
+    def __init__(self, max_waiters=COALESCE_MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self._flights    = {}           # key → [future, waiters]
+
+    async def do(self, key, fn, deadline=None):
+        flight = self._flights.get(key)
+        if flight is None:
+            future = asyncio.get_running_loop().create_future()
+            self._flights[key] = [future, 0]
+            result = None
+            try:
+                result = await fn()
+                return result, False
+            finally:
+                del self._flights[key]
+                coalesce_stats.inc("upstream_calls")
+                future.set_result(result)
+        if flight[1] >= self.max_waiters:
+            coalesce_stats.inc("overflow")
+            return await fn(), False
+        flight[1] += 1
+        coalesce_stats.inc("coalesced")
+        try:
+            result = await asyncio.wait_for(asyncio.shield(flight[0]),
+                                            max(time_left(deadline), 0))
+        except asyncio.TimeoutError:
+            result = None
+        if _shareable(result):
+            return result, True
+        coalesce_stats.inc("fallbacks")
+        return await fn(), False
+
+single_flight       = SingleFlight()
+async_single_flight = AsyncSingleFlight()
+
+# ─── Upstream connection pool ──────────────────────────────────
+UPSTREAM_TIMEOUT  = 5     # seconds, connect + read
+POOL_MAX_SIZE     = 32    # max open connections per instance (busy + idle)
+POOL_MAX_IDLE     = 8     # idle keep-alive sockets kept per instance
+POOL_IDLE_TIMEOUT = 30    # seconds before an idle socket is closed
+
+HOP_BY_HOP = ("connection", "keep-alive", "proxy-connection", "te", "trailers",
+              "transfer-encoding", "upgrade", "host", "content-length")
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """Persistent HTTP/1.1 connections to a single upstream instance."""
+
+    def __init__(self, base_url, max_size=POOL_MAX_SIZE, max_idle=POOL_MAX_IDLE,
+                 idle_timeout=POOL_IDLE_TIMEOUT, timeout=UPSTREAM_TIMEOUT):
+        parts = urlsplit(base_url)
+        self.base_url     = base_url
+        self.host         = parts.hostname
+        self.port         = parts.port or 80
+        self.max_size     = max_size
+        self.max_idle     = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+        self._idle        = []          # [(conn, last_used)], most recent last
+        self._busy        = 0
+        self._cond        = threading.Condition()
+        self.counters     = defaultdict(int)
+
+    def _is_stale(self, conn):
+        # An idle keep-alive socket should have nothing to read; if it is
+        # readable the peer has closed it (EOF) or sent something unexpected.
+        if conn.sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _evict_expired(self, now):
+        keep = []
+        for conn, last_used in self._idle:
+            if now - last_used > self.idle_timeout:
+                conn.close()
+                self.counters["evicted"] += 1
+            else:
+                keep.append((conn, last_used))
+        self._idle = keep
+
+    def acquire(self, timeout=None):
+        """Return (conn, reused). Blocks while the pool is at max_size, for
+        at most `timeout` seconds (the request's time left) when given."""
+        bounded  = timeout is not None and timeout < self.timeout
+        deadline = time.monotonic() + (timeout if bounded else self.timeout)
+        with self._cond:
+            while True:
+                self._evict_expired(time.monotonic())
+                while self._idle:
+                    conn, _ = self._idle.pop()
+                    if self._is_stale(conn):
+                        conn.close()
+                        self.counters["stale"] += 1
+                        continue
+                    self._busy += 1
+                    self.counters["reused"] += 1
+                    return conn, True
+                if self._busy < self.max_size:
+                    self._busy += 1
+                    self.counters["created"] += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.counters["timeouts"] += 1
+                    if bounded:
+                        raise TimeoutError("deadline exceeded waiting for a connection")
+                    raise PoolTimeout(f"connection pool for {self.base_url} exhausted")
+                self.counters["waits"] += 1
+                self._cond.wait(remaining)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def release(self, conn, reusable=True, stale=False):
+        with self._cond:
+            self._busy -= 1
+            if stale:
+                self.counters["stale"] += 1
+            if reusable and conn.sock is not None and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+            else:
+                conn.close()
+                self.counters["closed"] += 1
+            self._cond.notify()
+
+    def evict_idle(self):
+        with self._cond:
+            self._evict_expired(time.monotonic())
+
+    def stats(self):
+        with self._cond:
+            return {"busy": self._busy, "idle": len(self._idle),
+                    "max_size": self.max_size, **self.counters}
+
+pools      = {}
+pools_lock = threading.Lock()
+
+def get_pool(base_url):
+    pool = pools.get(base_url)
+    if pool is None:
+        with pools_lock:
+            pool = pools.setdefault(base_url, ConnectionPool(base_url))
+    return pool
+
+# ─── Adaptive concurrency limits ───────────────────────────────
+# Each instance has a concurrency limit driven by its latency, in the style
+# of a gradient limiter. Latency is judged per route against min_rtt, a low
+# percentile of that route's recent successful requests on the instance,
+# so slow /reports calls neither stand for nor squeeze the fast routes. The
+# limit grows by about sqrt(limit) while latency stays within
+# CONCURRENCY_TOLERANCE of min_rtt and shrinks in proportion once requests
+# queue inside the backend and latency climbs; a 5xx backs it off
+# multiplicatively. An instance counts as degrading while its smoothed
+# latency / min_rtt ratio is past CONCURRENCY_TOLERANCE, or for
+# CONCURRENCY_DEGRADED_HOLD after a 5xx. Selection skips instances at their limit, so
+# traffic spills over to ones with room; when every instance is full a
+# request waits up to CONCURRENCY_MAX_WAIT in a bounded per-service queue
+# for a slot, and is otherwise answered 503 rather than piling more work
+# onto an overloaded backend. The limit is only a guess at capacity, so an
+# instance with nowhere to spill over to that is not degrading is allowed
+# past it. Requests classed CONCURRENCY_EXEMPT by route, or made with a
+# verified token whose role is in CONCURRENCY_EXEMPT_ROLES, are never held
+# back (they are already bounded by priority admission); PRIORITY_HEADER
+# alone never exempts a request, since any client can set it. With several
+# workers, each applies the limits to its own traffic.
+CONCURRENCY_INITIAL_LIMIT    = 20
+CONCURRENCY_MIN_LIMIT        = 2
+CONCURRENCY_MAX_LIMIT        = 200
+CONCURRENCY_TOLERANCE        = 1.5    # latency / min_rtt ratio tolerated before shrinking
+CONCURRENCY_SMOOTHING        = 0.2    # share of each new estimate taken
+CONCURRENCY_BACKOFF          = 0.9    # limit multiplier on a 5xx
+CONCURRENCY_RTT_WINDOW       = 500    # recent samples kept per route
+CONCURRENCY_RTT_PERCENTILE   = 0.05   # of the window, taken as min_rtt
+CONCURRENCY_RTT_MIN_SAMPLES  = 20     # before a route's min_rtt is trusted
+CONCURRENCY_RTT_REFRESH      = 20     # samples between min_rtt recomputations
+CONCURRENCY_PRESSURE_ALPHA   = 0.05   # weight of a sample in the smoothed latency ratio
+CONCURRENCY_DEGRADED_HOLD    = 1.0    # seconds an instance counts as degrading after a 5xx
+CONCURRENCY_EXEMPT           = {"critical"}   # route priority classes never held to the limits
+CONCURRENCY_EXEMPT_ROLES     = set()          # verified "role" claims never held to the limits
+CONCURRENCY_QUEUE            = 64     # waiters per service
+CONCURRENCY_MAX_WAIT         = 0.1    # seconds a request waits for a slot
+
+concurrency_stats = CounterSet()
+
+class AdaptiveLimit:
+    """Concurrency limit of one instance; used under its service's lock."""
+
+    def __init__(self):
+        self.limit          = CONCURRENCY_INITIAL_LIMIT
+        self.samples        = {}    # route → deque of recent successful latencies (ms)
+        self.min_rtt        = {}    # route → low percentile of its samples (ms)
+        self.pressure       = 1.0   # smoothed latency / min_rtt
+        self.degraded_until = 0.0
+
+    def degrading(self):
+        return (self.pressure > CONCURRENCY_TOLERANCE
+                or time.monotonic() < self.degraded_until)
+
+    def _baseline(self, route, elapsed_ms):
+        samples = self.samples.get(route)
+        if samples is None:
+            samples = self.samples[route] = deque(maxlen=CONCURRENCY_RTT_WINDOW)
+        samples.append(elapsed_ms)
+        if len(samples) >= CONCURRENCY_RTT_MIN_SAMPLES and (
+                route not in self.min_rtt or len(samples) % CONCURRENCY_RTT_REFRESH == 0):
+            ordered = sorted(samples)
+            self.min_rtt[route] = max(ordered[int(len(ordered) * CONCURRENCY_RTT_PERCENTILE)], 0.1)
+        return self.min_rtt.get(route)
+
+    def update(self, elapsed_ms, status, in_flight, route=None):
+        """Feed a finished request; in_flight still includes it."""
+        if status == ABANDONED:
+            return      # cut short by the client's deadline: no signal
+        if status >= 500:
+            self.limit = max(self.limit * CONCURRENCY_BACKOFF, CONCURRENCY_MIN_LIMIT)
+            self.degraded_until = time.monotonic() + CONCURRENCY_DEGRADED_HOLD
+            return
+        min_rtt = self._baseline(route, elapsed_ms)
+        if min_rtt is None:
+            return
+        ratio          = max(elapsed_ms, 0.1) / min_rtt
+        self.pressure += CONCURRENCY_PRESSURE_ALPHA * (ratio - self.pressure)
+        gradient       = max(0.5, min(1.0, CONCURRENCY_TOLERANCE / ratio))
+        if in_flight < self.limit / 2:
+            return      # the limit is not being used, so latency says nothing about it
+        estimate   = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = min(max(self.limit + CONCURRENCY_SMOOTHING * (estimate - self.limit),
+                             CONCURRENCY_MIN_LIMIT), CONCURRENCY_MAX_LIMIT)
+
+    def snapshot(self):
+        return {"limit": round(self.limit, 1),
+                "min_rtt_ms": {route: round(rtt, 2) for route, rtt in self.min_rtt.items()},
+                "latency_ratio": round(self.pressure, 2), "degrading": self.degrading()}
+
+limiters      = {}
+limiters_lock = threading.Lock()
+
+def get_limiter(base_url):
+    limiter = limiters.get(base_url)
+    if limiter is None:
+        with limiters_lock:
+            limiter = limiters.setdefault(base_url, AdaptiveLimit())
+    return limiter
+
+def _abandon_slot_wait(svc, waiter):
+    with svc["lock"]:
+        if waiter in svc["slot_waiters"]:
+            svc["slot_waiters"].remove(waiter)
+        elif svc["slot_waiters"]:
+            svc["slot_waiters"].popleft().set()     # pass on the wakeup we got
+
+# ─── Balancing strategies ──────────────────────────────────────
+# Each service picks its strategy with an optional "strategy" key in
+# SERVICES (or at runtime via POST /services/<name>/strategy). Strategies
+# are called with the request's hash key, which only consistent_hash uses:
+# it places HASH_VNODES points per instance on a ring and sends a key to
+# the first usable instance clockwise of it, so a member keeps hitting the
+# same replica (and its warm caches), and adding or losing one of N
+# instances only moves about 1/N of the keys.
+#
+# Instances carry a capacity weight (1 unless configured) that the other
+# strategies honour; round_robin is smooth weighted round robin, so a
+# weight-2 instance gets every other request of a 2:1 pair rather than two
+# in a row. An instance that comes back healthy, or is newly registered,
+# starts slow: its weight ramps linearly from SLOW_START_MIN_FRACTION up to
+# full over the service's "slow_start" window while its caches and
+# connections warm up.
+DEFAULT_STRATEGY        = "round_robin"
+EWMA_ALPHA              = 0.3      # weight of the newest latency sample
+EWMA_FAILURE_PENALTY    = 1000.0   # ms charged to an instance for a 5xx/failed call
+HASH_VNODES             = 160      # ring points per instance
+SLOW_START_SECONDS      = 30       # default ramp window; 0 disables
+SLOW_START_MIN_FRACTION = 0.1      # share of its weight a recovering instance starts at
+# Where a request's hash key comes from, tried in order; the first present
+# wins. ("header", name) | ("query", param) | ("path", regex with one group)
+HASH_KEY_SOURCES     = [("header", "X-Member-ID"), ("query", "member_id"),
+                        ("path", r"^/members/([^/]+)"), ("path", r"/member/([^/]+)")]
+SERVICE_HASH_KEYS    = {}       # service → its own list of sources
+
+# Per-instance state kept as lists parallel to svc["instances"], with the
+# value a newly added instance starts from.
+INSTANCE_STATE = {
+    "healthy":     True,
+    "outstanding": 0,
+    "ewma_ms":     None,
+    "failures":    0,        # consecutive proxy failures
+    "weight":      1,        # configured capacity
+    "warm_since":  None,     # monotonic time a slow-start ramp began
+    "current":     0.0,      # smooth weighted round robin running score
+}
+
+def init_balancer_state(svc):
+    n = len(svc["instances"])
+    svc.setdefault("strategy", DEFAULT_STRATEGY)
+    svc.setdefault("index", 0)
+    for key, default in INSTANCE_STATE.items():
+        if len(svc.get(key, ())) != n:
+            svc[key] = [default] * n
+    svc["lock"] = threading.Lock()
+    svc["slot_waiters"] = deque()
+
+for _svc in SERVICES.values():
+    init_balancer_state(_svc)
+
+def _candidates(svc):
+    healthy = [i for i, ok in enumerate(svc["healthy"]) if ok]
+    # With nothing healthy, fail open rather than refuse every request.
+    return healthy or list(range(len(svc["instances"])))
+
+def effective_weight(svc, i, now):
+    """The instance's weight scaled down while it is still slow-starting."""
+    weight, since = svc["weight"][i], svc["warm_since"][i]
+    if since is None:
+        return weight
+    ramp = (now - since) / max(svc.get("slow_start", SLOW_START_SECONDS), 1e-9)
+    if ramp >= 1:
+        svc["warm_since"][i] = None
+        return weight
+    return weight * max(ramp, SLOW_START_MIN_FRACTION)
+
+def _expected_ms(svc, i):
+    ewma = svc["ewma_ms"][i]
+    if ewma is None:
+        # Unmeasured instances look as fast as the best one so they get traffic.
+        known = [e for e in svc["ewma_ms"] if e is not None]
+        ewma  = min(known) if known else 1.0
+    return max(ewma, 0.1)
+
+def pick_round_robin(svc, candidates, key=None):
+    now, current = time.monotonic(), svc["current"]
+    best, total  = None, 0.0
+    for i in candidates:
+        weight      = effective_weight(svc, i, now)
+        current[i] += weight
+        total      += weight
+        if best is None or current[i] > current[best]:
+            best = i
+    current[best] -= total
+    return best
+
+def pick_least_outstanding(svc, candidates, key=None):
+    n, now = len(svc["instances"]), time.monotonic()
+    start  = svc["index"] % n
+    svc["index"] = (start + 1) % n      # rotate tie-breaks
+    return min(candidates, key=lambda i: ((svc["outstanding"][i] + 1) / effective_weight(svc, i, now),
+                                          (i - start) % n))
+
+def pick_ewma(svc, candidates, key=None):
+    now     = time.monotonic()
+    weights = [effective_weight(svc, i, now) / _expected_ms(svc, i) for i in candidates]
+    return random.choices(candidates, weights)[0]
+
+def pick_power_of_two(svc, candidates, key=None):
+    if len(candidates) == 1:
+        return candidates[0]
+    a, b = random.sample(candidates, 2)
+    now  = time.monotonic()
+    cost = lambda i: _expected_ms(svc, i) * (svc["outstanding"][i] + 1) / effective_weight(svc, i, now)
+    return a if cost(a) <= cost(b) else b
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+def _hash_ring(svc):
+    """(points, owners) for the service's current instance list, rebuilt
+    whenever set_instances swaps the list."""
+    ring = svc.get("ring")
+    if ring is None or ring[0] is not svc["instances"]:
+        points = sorted((_hash(f"{url}#{v}"), i)
+                        for i, url in enumerate(svc["instances"]) for v in range(HASH_VNODES))
+        ring = svc["ring"] = (svc["instances"], [p for p, _ in points], [i for _, i in points])
+    return ring[1], ring[2]
+
+def pick_consistent_hash(svc, candidates, key=None):
+    if key is None:
+        return pick_round_robin(svc, candidates)
+    points, owners = _hash_ring(svc)
+    allowed = set(candidates)
+    start   = bisect.bisect(points, _hash(key))
+    for step in range(len(points)):
+        idx = owners[(start + step) % len(points)]
+        if idx in allowed:
+            return idx
+
+STRATEGIES = {
+    "round_robin":       pick_round_robin,
+    "least_outstanding": pick_least_outstanding,
+    "ewma":              pick_ewma,
+    "p2c":               pick_power_of_two,
+    "consistent_hash":   pick_consistent_hash,
+}
+
+def hash_key(svc_name, path, query, headers_lower):
+    """The request's consistent-hash key, or None when the service does not
+    hash or no key source matches."""
+    svc = SERVICES.get(svc_name)
+    if svc is None or svc["strategy"] != "consistent_hash":
+        return None
+    for source, spec in SERVICE_HASH_KEYS.get(svc_name, HASH_KEY_SOURCES):
+        if source == "header":
+            value = headers_lower.get(spec.lower())
+        elif source == "query":
+            value = parse_qs(query).get(spec, [None])[0]
+        else:
+            match = re.search(spec, path)
+            value = match.group(1) if match else None
+        if value:
+            return value
+    return None
+
+def _select_instance(svc, exclude, key, make_waiter=None, exempt=False):
+    """(url, waiter). When nothing is selectable because instances are at
+    their concurrency limit and make_waiter is given, url is None and the
+    waiter is queued to be woken once a slot frees (None if the queue is
+    full). `exempt` requests ignore the limits."""
+    with svc["lock"]:
+        candidates = [i for i in _candidates(svc) if svc["instances"][i] not in exclude]
+        open_slots = [i for i in candidates if exempt
+                      or svc["outstanding"][i] < get_limiter(svc["instances"][i]).limit]
+        over_limit = (not open_slots and len(candidates) == 1
+                      and not get_limiter(svc["instances"][candidates[0]]).degrading())
+        if over_limit:
+            open_slots = candidates     # nowhere to spill over and the backend is coping
+        saturated  = len(open_slots) < len(candidates)
+        while open_slots:
+            idx = STRATEGIES[svc["strategy"]](svc, open_slots, key)
+            if get_breaker(svc["instances"][idx]).allow():
+                svc["outstanding"][idx] += 1
+                if saturated:
+                    concurrency_stats.inc("redirected")
+                elif over_limit:
+                    concurrency_stats.inc("over_limit")
+                return svc["instances"][idx], None
+            open_slots.remove(idx)
+        if not saturated:
+            breaker_stats.inc("shed")
+            return None, None
+        if make_waiter is None or len(svc["slot_waiters"]) >= CONCURRENCY_QUEUE:
+            concurrency_stats.inc("rejected")
+            return None, None
+        waiter = make_waiter()
+        svc["slot_waiters"].append(waiter)
+        return None, waiter
+
+def get_next_instance(service_name, exclude=(), key=None):
+    """Pick an instance using the service's strategy and count it as in
+    flight; every call must be paired with release_instance(). Instances
+    in `exclude`, behind an open circuit breaker or at their concurrency
+    limit are skipped; returns None when nothing is left to try. `key` is
+    the request's hash key."""
+    return _select_instance(SERVICES[service_name], exclude, key)[0]
+
+def acquire_instance(service_name, exclude=(), key=None, deadline=None, exempt=False):
+    """get_next_instance, but when every usable instance is at its
+    concurrency limit wait up to CONCURRENCY_MAX_WAIT for a slot. `exempt`
+    requests (see concurrency_exempt) are not held to the limits."""
+    svc    = SERVICES[service_name]
+    until  = time.monotonic() + min(CONCURRENCY_MAX_WAIT, max(time_left(deadline), 0))
+    while True:
+        url, waiter = _select_instance(svc, exclude, key, threading.Event, exempt)
+        if waiter is None:
+            return url
+        concurrency_stats.inc("queued")
+        if not waiter.wait(until - time.monotonic()):
+            _abandon_slot_wait(svc, waiter)
+            concurrency_stats.inc("timed_out")
+            return None
+
+async def acquire_instance_async(service_name, exclude=(), key=None, deadline=None,
+                                 exempt=False):
+    svc    = SERVICES[service_name]
+    until  = time.monotonic() + min(CONCURRENCY_MAX_WAIT, max(time_left(deadline), 0))
+    while True:
+        url, waiter = _select_instance(svc, exclude, key, _AsyncGrant, exempt)
+        if waiter is None:
+            return url
+        concurrency_stats.inc("queued")
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), until - time.monotonic())
+        except asyncio.TimeoutError:
+            _abandon_slot_wait(svc, waiter)
+            concurrency_stats.inc("timed_out")
+            return None
+        except asyncio.CancelledError:
+            _abandon_slot_wait(svc, waiter)
+            raise
+
+def release_instance(service_name, base_url, elapsed_ms, status, route=None):
     svc = SERVICES[service_name]
-    idx = svc["index"] % len(svc["instances"])
-    svc["index"] = (idx + 1) % len(svc["instances"])
-    return svc["instances"][idx]
-
-def forward_request(target_url, method, headers, body):
-    try:
-        req_headers = {k: v for k, v in headers.items()
-                       if k.lower() not in ("host","content-length")}
-        req = urllib.request.Request(target_url, data=body, headers=req_headers, method=method)
-        with urllib.request.urlopen(req, timeout=5) as resp:
-            return resp.read(), resp.status, dict(resp.headers)
-    except urllib.error.HTTPError as e:
-        return e.read(), e.code, {}
+    marked_down = False
+    with svc["lock"]:
+        if base_url not in svc["instances"]:
+            return      # deregistered while the request was in flight
+        idx = svc["instances"].index(base_url)
+        get_limiter(base_url).update(elapsed_ms, status, svc["outstanding"][idx], route)
+        svc["outstanding"][idx] -= 1
+        if svc["slot_waiters"]:
+            svc["slot_waiters"].popleft().set()
+        sample = max(elapsed_ms, EWMA_FAILURE_PENALTY) if status >= 500 else elapsed_ms
+        prev   = svc["ewma_ms"][idx]
+        svc["ewma_ms"][idx] = sample if prev is None else prev + EWMA_ALPHA * (sample - prev)
+        if status >= 500:
+            svc["failures"][idx] += 1
+            if svc["failures"][idx] >= PASSIVE_FAIL_THRESHOLD and svc["healthy"][idx]:
+                svc["healthy"][idx] = False
+                marked_down = True
+        elif status != ABANDONED:       # an abandoned attempt is no verdict either way
+            svc["failures"][idx] = 0
+    if status == ABANDONED:
+        get_breaker(base_url).release()
+    else:
+        get_breaker(base_url).record(status < 500)
+    if marked_down:
+        health_stats.inc("passive_marks")
+        schedule_probe(service_name, base_url, HEALTH_MIN_INTERVAL)
+
+# ─── Circuit breakers and retries ──────────────────────────────
+# Every instance has a breaker. BREAKER_FAILURE_THRESHOLD consecutive 5xx or
+# connection failures open it. While open, get_next_instance skips the
+# instance and requests fail over (or are shed with a fast 503) instead of
+# waiting out the upstream timeout. After BREAKER_OPEN_SECONDS, a few trial
+# requests are let through (half-open) to decide whether to close it again.
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SECONDS      = 10
+BREAKER_HALF_OPEN_TRIALS  = 1
+RETRY_METHODS             = ("GET", "PUT", "DELETE")    # idempotent
+RETRY_STATUSES            = (502, 503, 504)
+RETRY_MAX_ATTEMPTS        = 2       # first try + one failover
+RETRY_BUDGET_RATIO        = 0.1     # retries earned per request
+RETRY_BUDGET_MIN_PER_SEC  = 1.0     # floor so low-traffic services can still retry
+RETRY_BUDGET_MAX          = 10.0
+
+breaker_stats = CounterSet()
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self):
+        self.state     = self.CLOSED
+        self.failures  = 0
+        self.opened_at = 0.0
+        self.trials    = 0
+        self._lock     = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                    return False
+                self.state, self.trials = self.HALF_OPEN, 0
+            if self.state == self.HALF_OPEN:
+                if self.trials >= BREAKER_HALF_OPEN_TRIALS:
+                    return False
+                self.trials += 1
+            return True
+
+    def record(self, success):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trials = max(0, self.trials - 1)
+            if success:
+                if self.state != self.CLOSED:
+                    breaker_stats.inc("closed")
+                self.state, self.failures = self.CLOSED, 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= BREAKER_FAILURE_THRESHOLD:
+                if self.state != self.OPEN:
+                    breaker_stats.inc("opened")
+                self.state, self.opened_at = self.OPEN, time.monotonic()
+
+    def release(self):
+        """Give back a half-open trial that ended without a verdict."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.trials = max(0, self.trials - 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "failures": self.failures}
+
+breakers      = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(base_url):
+    breaker = breakers.get(base_url)
+    if breaker is None:
+        with breakers_lock:
+            breaker = breakers.setdefault(base_url, CircuitBreaker())
+    return breaker
+
+class RetryBudget:
+    """Retries are paid for by traffic: each request deposits
+    RETRY_BUDGET_RATIO of a token, each retry spends a whole one, so
+    retries can never add more than ~10% load on top of real requests."""
+
+    ratio, min_per_sec, maximum = RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN_PER_SEC, RETRY_BUDGET_MAX
+    stats, stat                 = breaker_stats, "retries"
+
+    def __init__(self):
+        self.tokens = self.maximum
+        self.last   = time.monotonic()
+        self._lock  = threading.Lock()
+
+    def _refill(self, amount):
+        self.tokens = min(self.maximum, self.tokens + amount)
+
+    def deposit(self):
+        with self._lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            now = time.monotonic()
+            self._refill((now - self.last) * self.min_per_sec)
+            self.last = now
+            if self.tokens < 1:
+                self.stats.inc(f"{self.stat}_denied")
+                return False
+            self.tokens -= 1
+            self.stats.inc(self.stat)
+            return True
+
+retry_budgets = defaultdict(RetryBudget)
+
+def should_retry(service_name, method, body, attempt, status, data):
+    # Streamed request bodies cannot be replayed, and a streamed response
+    # would have to be drained first; neither is worth a retry.
+    if (attempt >= min(RETRY_MAX_ATTEMPTS, len(SERVICES[service_name]["instances"]))
+            or method not in RETRY_METHODS
+            or status not in RETRY_STATUSES or not isinstance(data, bytes)
+            or not isinstance(body, (bytes, type(None)))):
+        return False
+    return retry_budgets[service_name].withdraw()
+
+def no_instance_response(service_name):
+    return json.dumps({"error": f"No available instance for {service_name} (all "
+                                f"unhealthy, circuit open or at their concurrency limit)"}
+                      ).encode(), 503, {}
+
+class UpstreamCancel:
+    """Lets another thread abort an upstream attempt blocked in socket I/O.
+    cancel() shuts the attempt's socket down, which makes the blocked call
+    fail at once. A connection is only reachable while attached, and it is
+    detached before going back to the pool, so a late cancel can never hit
+    a socket that another request has picked up."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._conn     = None
+        self._lock     = threading.Lock()
+
+    def attach(self, conn):
+        with self._lock:
+            if self.cancelled:
+                raise ConnectionAbortedError("upstream attempt cancelled")
+            self._conn = conn
+
+    def detach(self):
+        with self._lock:
+            self._conn = None
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self._conn is not None and self._conn.sock is not None:
+                try:
+                    self._conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+def release_upstream(pool, conn, cancel, **kwargs):
+    """pool.release(), detaching `conn` from its UpstreamCancel first."""
+    if cancel is not None:
+        cancel.detach()
+    pool.release(conn, **kwargs)
+
+def open_upstream(target_url, method, headers, body, content_length=None, trace=None,
+                  deadline=None, cancel=None):
+    """Send a request on a pooled connection and return (resp, pool, conn)
+    with the response headers read and the body still unread. The caller
+    must hand the connection back with pool.release() once done with resp.
+    `body` may be bytes or a file-like object read in chunks by http.client;
+    content_length is forwarded when known, otherwise the body goes chunked.
+    With a `trace` dict, connect and time-to-first-byte are added to it;
+    socket operations are bounded by the time left before `deadline`, and
+    the connection is attached to `cancel` (an UpstreamCancel) if given."""
+    parts    = urlsplit(target_url)
+    pool     = get_pool(f"{parts.scheme}://{parts.netloc}")
+    path     = parts.path + (f"?{parts.query}" if parts.query else "")
+    req_headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+    if content_length is not None:
+        req_headers["Content-Length"] = str(content_length)
+    replayable = body is None or isinstance(body, (bytes, bytearray))
+    while True:
+        began        = time.perf_counter()
+        conn, reused = pool.acquire(max(time_left(deadline), 0))
+        try:
+            timeout = time_left(deadline)
+            if timeout <= 0:
+                raise TimeoutError("deadline exceeded")
+            conn.timeout = timeout
+            if conn.sock is None:
+                conn.connect()
+            else:
+                conn.sock.settimeout(timeout)
+            if cancel is not None:
+                cancel.attach(conn)
+            sent = stage_mark(trace, "connect", began)
+            conn.request(method, path, body=body, headers=req_headers,
+                         encode_chunked=not replayable and content_length is None)
+            resp = conn.getresponse()
+            stage_mark(trace, "ttfb", sent)
+            return resp, pool, conn
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            release_upstream(pool, conn, cancel, reusable=False, stale=reused)
+            # A kept-alive socket can be closed by the peer between the
+            # staleness check and the write; retry on another socket.
+            if reused and replayable and not (cancel is not None and cancel.cancelled):
+                continue
+            raise
+        except BaseException:
+            release_upstream(pool, conn, cancel, reusable=False)
+            raise
+
+# ─── Streaming passthrough ─────────────────────────────────────
+STREAM_THRESHOLD  = 256 * 1024  # bodies larger than this (or of unknown size) are streamed
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def should_stream(content_length):
+    return STREAM_THRESHOLD is not None and (content_length is None
+                                             or content_length > STREAM_THRESHOLD)
+
+def relay_body(resp, pool, conn, trace=None, cancel=None):
+    """Yield the upstream body chunk by chunk, returning the connection to
+    the pool when the body is exhausted or the client goes away."""
+    reusable, began = False, time.perf_counter()
+    try:
+        while True:
+            chunk = resp.read1(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        resp.close()        # read1() never marks the response done, unlike read()
+        reusable = not resp.will_close
+    finally:
+        stage_mark(trace, "transfer", began)
+        release_upstream(pool, conn, cancel, reusable=reusable)
+
+def forward_request_streaming(target_url, method, headers, body, content_length=None,
+                              trace=None, deadline=None, cancel=None):
+    """Send a request upstream and return (data, status, headers). Large or
+    unsized upstream bodies come back as a chunk iterator instead of bytes
+    so the LB never buffers them. Running out of time answers 504."""
+    try:
+        resp, pool, conn = open_upstream(target_url, method, headers, body, content_length,
+                                         trace, deadline, cancel)
+        resp_headers = dict(resp.getheaders())
+        length = resp.getheader("Content-Length")
+        if not should_stream(int(length) if length is not None else None):
+            began = time.perf_counter()
+            try:
+                data = resp.read()
+            except BaseException:
+                release_upstream(pool, conn, cancel, reusable=False)
+                raise
+            release_upstream(pool, conn, cancel, reusable=not resp.will_close)
+            stage_mark(trace, "transfer", began)
+            return data, resp.status, resp_headers
+        return relay_body(resp, pool, conn, trace, cancel), resp.status, resp_headers
+    except TimeoutError as e:
+        return json.dumps({"error": str(e) or "upstream timed out"}).encode(), 504, {}
     except Exception as e:
         return json.dumps({"error": str(e)}).encode(), 503, {}
 
-def detect_service(path):
-    for svc, routes in SERVICE_ROUTES.items():
-        for route in routes:
-            if path.startswith(route):
-                return svc
+# ─── Timeouts and deadlines ────────────────────────────────────
+# Each route has a time budget (ROUTE_TIMEOUTS, else UPSTREAM_TIMEOUT) that
+# covers the whole proxied request, admission wait, retries and hedges
+# included. The absolute deadline goes upstream as X-Request-Deadline (Unix
+# epoch milliseconds) so services can drop work whose answer nobody will
+# read; a client may send an earlier deadline of its own, which is honoured
+# and passed on. Every upstream attempt is bounded by the time left, and a
+# request that runs out answers 504 and is counted per route. Running out
+# of the route's own budget is the instance's fault and counts as a
+# failure, so a hung instance still opens its breaker. An attempt cut short
+# by the client's earlier deadline, or dropped by the LB itself (a hedging
+# loser), is released as ABANDONED instead: its elapsed time still feeds
+# the instance's latency average, but it touches neither the breaker nor
+# the failure count, so clients with tight deadlines cannot trip breakers
+# or passive health marks.
+ROUTE_TIMEOUTS  = {"/members": 2, "/contributions": 3, "/loans": 3, "/savings": 3,
+                   "/investments": 3, "/dividends": 3, "/portfolio": 5,
+                   "/notifications": 5, "/reports": 30}
+DEADLINE_HEADER = "X-Request-Deadline"
+ABANDONED       = 499               # status released for attempts the LB gave up on
+
+deadline_counts = CounterSet()      # (service, route) → requests that ran out of time
+
+class Deadline(float):
+    """Absolute deadline in time.time() seconds; by_client is True when the
+    client's X-Request-Deadline was earlier than the route budget."""
+    by_client = False
+
+def request_deadline(route, client_deadline=None):
+    """Absolute deadline, as a Deadline, for a request on `route`."""
+    deadline = Deadline(time.time() + ROUTE_TIMEOUTS.get(route, UPSTREAM_TIMEOUT))
+    try:
+        client = Deadline(int(client_deadline) / 1000)
+    except (TypeError, ValueError):
+        return deadline
+    if client >= deadline:
+        return deadline
+    client.by_client = True
+    return client
+
+def time_left(deadline):
+    return deadline - time.time() if deadline is not None else UPSTREAM_TIMEOUT
+
+def upstream_headers(headers, request_id, deadline, claims):
+    """Client headers plus the LB's X-Request-ID, X-Request-Deadline and
+    verified claim headers."""
+    fields = {k: v for k, v in headers.items() if k.lower() not in LB_SET_HEADERS}
+    fields["X-Request-ID"]  = request_id
+    fields[DEADLINE_HEADER] = str(int(deadline * 1000))
+    fields.update(claim_headers(claims))
+    return fields
+
+def deadline_exceeded(svc_name, route, deadline, status):
+    """Count a request that ran out of time; True if it did."""
+    if status != 504 or time_left(deadline) > 0:
+        return False
+    deadline_counts.inc((svc_name, route))
+    return True
+
+def attempt_outcome(status, deadline):
+    """Status to release an instance with: a 504 produced because the
+    client's own deadline passed says nothing about the instance. Running
+    out of the route budget is left a 504, i.e. a failure."""
+    if status == 504 and getattr(deadline, "by_client", False) and time_left(deadline) <= 0:
+        return ABANDONED
+    return status
+
+def deadline_response():
+    return json.dumps({"error": "Deadline exceeded"}).encode(), 504, {}
+
+# ─── Request hedging ───────────────────────────────────────────
+# Bodyless GETs on HEDGE_ROUTES are hedged: if the chosen instance has not
+# answered within the route's recent p95 (clamped to HEDGE_MIN/MAX_DELAY_MS)
+# the same request goes to a second instance and the first good answer
+# wins. Hedges are paid for from a per-service budget, like retries, so
+# they add at most about HEDGE_BUDGET_RATIO extra upstream load. The losing
+# attempt is cancelled and released without a verdict on its instance: the
+# asyncio engine cancels its task, the threaded engine shuts its socket
+# down (UpstreamCancel) to break the blocking read.
+#
+# In the threaded engine the primary runs on the request thread. One shared
+# hedge_timer thread starts backups whose delay has passed on
+# hedge_executor, which only ever runs backups; the budget keeps those to a
+# few percent of requests, so the executor stays small.
+HEDGE_ROUTES             = {"/members", "/contributions", "/loans", "/savings",
+                            "/investments", "/dividends", "/portfolio"}
+HEDGE_MIN_SAMPLES        = 100      # route samples in the last minute before hedging
+HEDGE_MIN_DELAY_MS       = 5
+HEDGE_MAX_DELAY_MS       = 1000
+HEDGE_DELAY_REFRESH      = 1        # seconds a computed delay is reused
+HEDGE_BUDGET_RATIO       = 0.05
+HEDGE_BUDGET_MIN_PER_SEC = 0.2
+HEDGE_BUDGET_MAX         = 5.0
+HEDGE_WORKERS            = 32       # concurrent threaded-engine backups
+
+hedge_stats    = CounterSet()
+hedge_delays   = {}                 # route → (expires (monotonic), delay in seconds or None)
+hedge_losers   = set()              # cancelled asyncio losers, referenced until they unwind
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+class HedgeTimer:
+    """Runs callbacks after a delay on one shared thread, so waiting to
+    hedge costs no thread per request. Callbacks must not block."""
+
+    def __init__(self):
+        self._heap   = []               # [due (monotonic), seq, fn or None]
+        self._seq    = itertools.count()
+        self._cond   = threading.Condition()
+        self._thread = None
+
+    def schedule(self, delay, fn):
+        entry = [time.monotonic() + delay, next(self._seq), fn]
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="hedge-timer",
+                                                daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                fn = heapq.heappop(self._heap)[2]
+            if fn is not None:
+                try:
+                    fn()
+                except Exception as e:
+                    print(f"[LB] hedge timer: {e!r}")
+
+hedge_timer = HedgeTimer()
+
+class HedgeBudget(RetryBudget):
+    ratio, min_per_sec, maximum = HEDGE_BUDGET_RATIO, HEDGE_BUDGET_MIN_PER_SEC, HEDGE_BUDGET_MAX
+    stats, stat                 = hedge_stats, "hedges"
+
+hedge_budgets = defaultdict(HedgeBudget)
+
+def hedge_delay(svc_name, route, method, body):
+    """Seconds to wait before hedging this request, or None not to hedge."""
+    if (method != "GET" or body is not None or route not in HEDGE_ROUTES
+            or len(SERVICES[svc_name]["instances"]) < 2):
+        return None
+    hedge_budgets[svc_name].deposit()
+    now    = time.monotonic()
+    cached = hedge_delays.get(route)
+    if cached and cached[0] > now:
+        return cached[1]
+    hist    = latency_by_route.get(route)
+    summary = hist.summary(LATENCY_WINDOWS["1m"]) if hist else None
+    delay   = None
+    if summary and summary["count"] >= HEDGE_MIN_SAMPLES:
+        delay = min(max(summary["p95"], HEDGE_MIN_DELAY_MS), HEDGE_MAX_DELAY_MS) / 1000
+    hedge_delays[route] = (now + HEDGE_DELAY_REFRESH, delay)
+    return delay
+
+def forward_attempt(svc_name, base_url, target, method, headers, body, content_length=None,
+                    trace=None, deadline=None, cancel=None):
+    """Forward to an instance taken with get_next_instance and release it;
+    returns (base_url, data, status, headers). An attempt stopped through
+    `cancel` is released as ABANDONED."""
+    began = time.time()
+    data, status, resp_headers = forward_request_streaming(
+        base_url + target, method, headers, body, content_length, trace, deadline, cancel)
+    outcome = ABANDONED if cancel is not None and cancel.cancelled else attempt_outcome(status,
+                                                                                       deadline)
+    release_instance(svc_name, base_url, round((time.time() - began) * 1000, 2), outcome,
+                     detect_route(target.partition("?")[0])[1])
+    return base_url, data, status, resp_headers
+
+def discard_response(result):
+    """Give back the connection behind an unwanted streamed body (a
+    generator's finally only runs once it has been started)."""
+    data = result[1]
+    if not isinstance(data, bytes):
+        next(data, None)
+        data.close()
+
+def pick_winner(done, pending):
+    """The first non-5xx result among `done`, or any once nothing is pending."""
+    good = [f for f in done if f.result()[2] < 500]
+    if good or not pending:
+        return (good or list(done))[0]
     return None
 
+class _HedgeRace:
+    """State shared by the attempts of one threaded hedged request; guarded
+    by its lock."""
+
+    def __init__(self):
+        self.lock          = threading.Lock()
+        self.backup_done   = threading.Event()
+        self.winner        = None   # result handed to the client, once decided
+        self.backup_cancel = None   # UpstreamCancel of the backup, once started
+        self.failed_backup = None   # a backup's 5xx result while the primary still runs
+
+def forward_hedged(svc_name, base_url, target, method, headers, delay, tried, trace=None,
+                   deadline=None):
+    """Hedged forward_attempt: the primary runs on the calling thread and,
+    if it has not answered within `delay`, a backup is started on
+    hedge_executor. The first non-5xx answer wins and the other attempt is
+    cancelled. `trace` receives the stage timings of the winning attempt."""
+    race    = _HedgeRace()
+    traces  = {base_url: {}}
+    primary = UpstreamCancel()
+
+    def run_backup(backup_url, cancel):
+        result = forward_attempt(svc_name, backup_url, target, method, headers, None,
+                                 trace=traces[backup_url], deadline=deadline, cancel=cancel)
+        with race.lock:
+            lost = race.winner is not None
+            if not lost and result[2] < 500:
+                race.winner = result
+                primary.cancel()
+                hedge_stats.inc("backup_wins")
+                hedge_stats.inc("losers_cancelled")
+            elif not lost:
+                race.failed_backup = result
+        race.backup_done.set()
+        if lost:
+            discard_response(result)
+
+    def launch_backup():        # on the hedge timer thread
+        with race.lock:
+            if race.winner is not None or not hedge_budgets[svc_name].withdraw():
+                return
+            backup_url = get_next_instance(svc_name, exclude=tried)
+            if backup_url is None:
+                return
+            tried.append(backup_url)
+            traces[backup_url] = {}
+            race.backup_cancel = UpstreamCancel()
+        hedge_executor.submit(run_backup, backup_url, race.backup_cancel)
+
+    timer  = hedge_timer.schedule(delay, launch_backup)
+    result = forward_attempt(svc_name, base_url, target, method, headers, None,
+                             trace=traces[base_url], deadline=deadline, cancel=primary)
+    HedgeTimer.cancel(timer)
+    with race.lock:
+        if race.winner is None and (result[2] < 500 or race.backup_cancel is None):
+            race.winner = result
+            if race.backup_cancel is not None:
+                race.backup_cancel.cancel()
+                hedge_stats.inc("losers_cancelled")
+        waiting = race.winner is None
+    if waiting:                 # the primary failed while a backup is still out
+        race.backup_done.wait()
+        with race.lock:
+            if race.winner is None:
+                race.winner = result    # both failed: answer with the primary's error
+                discard_response(race.failed_backup)
+    if race.winner is not result:
+        discard_response(result)
+    if trace is not None:
+        trace.update(traces[race.winner[0]])
+    return race.winner
+
+# ─── Edge authentication ───────────────────────────────────────
+# With CHAMA_JWT_SECRET set, proxied requests must carry a bearer JWT signed
+# with it (HS256/384/512); anything else is answered 401 before it reaches
+# the cache or an upstream, so no separate auth hop is needed. Verified
+# tokens are kept in an LRU keyed by signature until their `exp`, so repeat
+# calls with the same token skip the HMAC and JSON parsing. Verified claims
+# go to the services as JWT_CLAIM_HEADERS (copies sent by the client are
+# always dropped) and the subject picks the client's rate-limit bucket.
+JWT_SECRET        = os.environ.get("CHAMA_JWT_SECRET", "").encode()
+JWT_ALGORITHMS    = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+JWT_LEEWAY        = 30          # seconds of clock skew allowed on exp/nbf
+JWT_CACHE_SIZE    = 10000       # verified tokens remembered
+JWT_PUBLIC_ROUTES = set()       # routes that may be called without a token
+JWT_CLAIM_HEADERS = {"sub": "X-Auth-Subject", "role": "X-Auth-Role",
+                     "chama_id": "X-Auth-Chama", "scope": "X-Auth-Scope"}
+# Request headers only the LB may set; client-supplied copies are dropped.
+LB_SET_HEADERS    = {"x-request-id", DEADLINE_HEADER.lower(),
+                     *(name.lower() for name in JWT_CLAIM_HEADERS.values())}
+
+class AuthError(Exception):
+    """A bearer token that failed verification; the message is the reason."""
+
+def _b64decode(segment):
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+def decode_jwt(token, secret, now):
+    """Claims of an HMAC-signed JWT, or raise AuthError."""
+    parts = token.split(".")
+    if len(parts) != 3:
+        raise AuthError("malformed token")
+    try:
+        header, claims = json.loads(_b64decode(parts[0])), json.loads(_b64decode(parts[1]))
+        signature      = _b64decode(parts[2])
+    except ValueError:
+        raise AuthError("malformed token") from None
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise AuthError("malformed token")
+    digest = JWT_ALGORITHMS.get(header.get("alg"))
+    if digest is None:
+        raise AuthError("unsupported algorithm")
+    expected = hmac.new(secret, f"{parts[0]}.{parts[1]}".encode(), digest).digest()
+    if not hmac.compare_digest(expected, signature):
+        raise AuthError("bad signature")
+    exp, nbf = claims.get("exp"), claims.get("nbf")
+    if not isinstance(exp, (int, float)):
+        raise AuthError("missing exp")
+    if now > exp + JWT_LEEWAY:
+        raise AuthError("token expired")
+    if isinstance(nbf, (int, float)) and now + JWT_LEEWAY < nbf:
+        raise AuthError("token not yet valid")
+    return claims
+
+class TokenVerifier:
+    """decode_jwt behind an LRU of verified tokens keyed by signature."""
+
+    def __init__(self, secret, max_entries=JWT_CACHE_SIZE):
+        self.secret      = secret
+        self.max_entries = max_entries
+        self._tokens     = OrderedDict()    # signature → (token, claims, expires)
+        self._lock       = threading.Lock()
+        self.counters    = defaultdict(int)
+        self.rejections  = defaultdict(int)
+
+    def verify(self, token):
+        began     = time.perf_counter_ns()
+        now       = time.time()
+        signature = token.rpartition(".")[2]
+        with self._lock:
+            entry = self._tokens.get(signature)
+            # The whole token must match: a signature only vouches for the
+            # header and payload it was computed over.
+            if entry is not None and entry[0] == token and now <= entry[2]:
+                self._tokens.move_to_end(signature)
+                self.counters["cache_hits"] += 1
+                self.counters["hit_ns"]     += time.perf_counter_ns() - began
+                return entry[1]
+        try:
+            claims = decode_jwt(token, self.secret, now)
+        except AuthError as e:
+            with self._lock:
+                self.rejections[str(e)]    += 1
+                self.counters["verify_ns"] += time.perf_counter_ns() - began
+            raise
+        with self._lock:
+            self._tokens[signature] = (token, claims, claims["exp"] + JWT_LEEWAY)
+            self._tokens.move_to_end(signature)
+            while len(self._tokens) > self.max_entries:
+                self._tokens.popitem(last=False)
+            self.counters["verified"]  += 1
+            self.counters["verify_ns"] += time.perf_counter_ns() - began
+        return claims
+
+    def missing(self):
+        with self._lock:
+            self.counters["missing"] += 1
+
+    def stats(self):
+        with self._lock:
+            hits, verified = self.counters["cache_hits"], self.counters["verified"]
+            checked        = verified + sum(self.rejections.values())
+            return {"enabled": True, "cached_tokens": len(self._tokens),
+                    "cache_hits": hits, "verified": verified,
+                    "missing": self.counters["missing"], "rejected": dict(self.rejections),
+                    "cache_hit_rate": round(hits / (hits + checked), 4) if hits + checked else None,
+                    "avg_verify_us": (round(self.counters["verify_ns"] / checked / 1000, 2)
+                                      if checked else None),
+                    "avg_cache_hit_us": round(self.counters["hit_ns"] / hits / 1000, 2) if hits else None}
+
+token_verifier = TokenVerifier(JWT_SECRET) if JWT_SECRET else None
+
+def authenticate(authorization, route):
+    """(verified claims, None) or (None, 401 (body, status, headers)). Claims
+    are empty with edge auth off, or for a public route called anonymously."""
+    if token_verifier is None:
+        return {}, None
+    if not authorization or authorization[:7].lower() != "bearer ":
+        if route in JWT_PUBLIC_ROUTES:
+            return {}, None
+        token_verifier.missing()
+        reason = "missing bearer token"
+    else:
+        try:
+            return token_verifier.verify(authorization[7:].strip()), None
+        except AuthError as e:
+            reason = str(e)
+    body = json.dumps({"error": "Unauthorized", "reason": reason}).encode()
+    return None, (body, 401, {"WWW-Authenticate": f'Bearer error="invalid_token", '
+                                                  f'error_description="{reason}"'})
+
+def auth_stats():
+    return token_verifier.stats() if token_verifier is not None else {"enabled": False}
+
+def claim_headers(claims):
+    """Verified claims as upstream headers."""
+    headers = {}
+    for claim, name in JWT_CLAIM_HEADERS.items():
+        value = claims.get(claim)
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = " ".join(map(str, value))
+        elif isinstance(value, dict):
+            value = json.dumps(value, separators=(",", ":"))
+        headers[name] = str(value)
+    return headers
+
+# ─── Rate limiting and load shedding ───────────────────────────
+# Every proxied request takes a token from its client's bucket and, for
+# routes listed in RATE_LIMIT_ROUTES, from that route's shared bucket; an
+# empty bucket answers 429 with Retry-After. Clients are keyed by the JWT
+# subject when edge auth has verified the token, else by IP: an unverified
+# subject is whatever the client chose to write, so keying on it would let
+# a client take a fresh bucket per request. Buckets live in one
+# bounded LRU table: a bucket untouched for long enough to have refilled is
+# indistinguishable from a new one, so it can be dropped without changing
+# any decision. Independently, once SHED_MAX_IN_FLIGHT requests are already
+# waiting on upstreams, new ones get an immediate 503 (see Priority
+# admission) so that overload shows up as fast rejections instead of
+# ever-longer backend queues.
+RATE_LIMIT_CLIENT   = (20.0, 40)        # (tokens per second, burst) per client
+RATE_LIMIT_ROUTES   = {"/reports": (10.0, 20), "/notifications": (20.0, 40)}
+RATE_LIMIT_MAX_KEYS = 10000
+SHED_MAX_IN_FLIGHT  = 256
+SHED_RETRY_AFTER    = 1                 # seconds suggested to shed clients
+
+limit_counts = CounterSet()
+
+class RateLimiter:
+    def __init__(self, max_keys=RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()   # key → [tokens, last refill (monotonic)]
+        self._lock    = threading.Lock()
+        self.evicted  = 0
+
+    def take(self, key, rate, burst):
+        """Take one token; return 0 if allowed, else seconds until one is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(burst), now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+    def expire(self):
+        """Drop buckets idle long enough to be full again."""
+        now, full_after = time.monotonic(), max(b / r for r, b in
+                                                [RATE_LIMIT_CLIENT, *RATE_LIMIT_ROUTES.values()])
+        with self._lock:
+            while self._buckets:
+                key, (_, last) = next(iter(self._buckets.items()))
+                if now - last < full_after:
+                    break
+                del self._buckets[key]
+
+    def stats(self):
+        return {"keys": len(self._buckets), "evicted": self.evicted}
+
+rate_limiter = RateLimiter()
+
+def client_key(remote_addr, claims):
+    """Rate-limit bucket of a request; `claims` are the verified ones."""
+    sub = claims.get("sub")
+    return f"sub:{sub}" if sub is not None else f"ip:{remote_addr}"
+
+def rate_limit(client, route):
+    """None if the request may proceed, else a 429 (body, status, headers)."""
+    wait = rate_limiter.take(("client", client), *RATE_LIMIT_CLIENT)
+    scope = "client"
+    if not wait and route in RATE_LIMIT_ROUTES:
+        wait, scope = rate_limiter.take(("route", route), *RATE_LIMIT_ROUTES[route]), "route"
+    if not wait:
+        return None
+    limit_counts.inc(("rate_limited", scope))
+    body = json.dumps({"error": f"Rate limit exceeded ({scope})", "route": route}).encode()
+    return body, 429, {"Retry-After": str(max(1, math.ceil(wait)))}
+
+def limits_stats():
+    counts = limit_counts.snapshot()
+    return {"in_flight": admission.current, "max_in_flight": SHED_MAX_IN_FLIGHT,
+            "rate_limited_client": counts.get(("rate_limited", "client"), 0),
+            "rate_limited_route":  counts.get(("rate_limited", "route"), 0),
+            "priority": admission.stats(), **rate_limiter.stats()}
+
+# ─── Priority admission ────────────────────────────────────────
+# Proxied requests are classed by PRIORITY_HEADER (a class name or an alias
+# such as "ussd") or else by the longest matching PRIORITY_ROUTES prefix,
+# defaulting to "normal". Each class has its own concurrency limit, and a
+# request over it waits in a bounded FIFO for up to max_wait before being
+# shed. On top of that, a class is shed outright once total in-flight
+# requests reach its shed_at level, so as load climbs bulk work (reports,
+# broadcasts) is turned away first, then normal traffic at
+# SHED_MAX_IN_FLIGHT, while "critical" USSD sessions, which face carrier
+# timeouts of a few seconds, are only bounded by their own limit. Only a
+# request that actually goes upstream holds a slot: coalesced followers
+# wait on their leader's call without one, so a burst of identical report
+# requests costs one bulk slot rather than filling the class.
+PRIORITY_HEADER  = "X-Chama-Priority"
+PRIORITY_ALIASES = {"ussd": "critical", "interactive": "normal", "batch": "bulk"}
+PRIORITY_ROUTES  = {"/reports": "bulk", "/notifications/broadcast": "bulk"}
+PRIORITY_DEFAULT = "normal"
+PRIORITY_CLASSES = {
+    # limit: concurrent upstream requests; queue/max_wait: waiters over the limit;
+    # shed_at: total in-flight level at which new requests of the class are shed
+    # (HEDGE_WORKERS is sized from the summed limits; raise it with them)
+    "critical": {"limit": 64,  "queue": 64, "max_wait": 0.5, "shed_at": None},
+    "normal":   {"limit": 192, "queue": 64, "max_wait": 0.5, "shed_at": SHED_MAX_IN_FLIGHT},
+    "bulk":     {"limit": 16,  "queue": 32, "max_wait": 2.0, "shed_at": SHED_MAX_IN_FLIGHT // 2},
+}
+
+class _AsyncGrant:
+    """Waiter for the asyncio engine, woken from whichever thread releases."""
+
+    def __init__(self):
+        self.loop   = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def set(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+class PriorityAdmission:
+    def __init__(self, classes=PRIORITY_CLASSES):
+        self.classes = {name: {**conf, "busy": 0, "waiters": deque()}
+                        for name, conf in classes.items()}
+        self.current = 0
+        self.counts  = CounterSet()     # (class, admitted|queued|shed|timed_out)
+        self._lock   = threading.Lock()
+
+    def _enter(self, name, make_waiter):
+        """True if admitted now, False if shed, else a waiter to block on."""
+        cls = self.classes[name]
+        with self._lock:
+            if cls["shed_at"] is not None and self.current >= cls["shed_at"]:
+                return False
+            if cls["busy"] < cls["limit"] and not cls["waiters"]:
+                cls["busy"] += 1
+                self.current += 1
+                return True
+            if len(cls["waiters"]) >= cls["queue"]:
+                return False
+            waiter = make_waiter()
+            cls["waiters"].append(waiter)
+            return waiter
+
+    def _abandon(self, name, waiter):
+        """After a timed-out wait: False if still queued (and now removed),
+        True if a slot was handed over in the meantime."""
+        with self._lock:
+            waiters = self.classes[name]["waiters"]
+            if waiter in waiters:
+                waiters.remove(waiter)
+                return False
+            return True
+
+    def _count(self, name, admitted, queued):
+        if queued:
+            self.counts.inc((name, "queued"))
+            if not admitted:
+                self.counts.inc((name, "timed_out"))
+        else:
+            self.counts.inc((name, "admitted" if admitted else "shed"))
+        return admitted
+
+    def acquire(self, name):
+        entered = self._enter(name, threading.Event)
+        if isinstance(entered, bool):
+            return self._count(name, entered, False)
+        admitted = entered.wait(self.classes[name]["max_wait"]) or self._abandon(name, entered)
+        return self._count(name, admitted, True)
+
+    async def acquire_async(self, name):
+        entered = self._enter(name, _AsyncGrant)
+        if isinstance(entered, bool):
+            return self._count(name, entered, False)
+        try:
+            await asyncio.wait_for(asyncio.shield(entered.future), self.classes[name]["max_wait"])
+            admitted = True
+        except asyncio.TimeoutError:
+            admitted = self._abandon(name, entered)
+        except asyncio.CancelledError:
+            if self._abandon(name, entered):
+                self.release(name)
+            raise
+        return self._count(name, admitted, True)
+
+    def release(self, name):
+        cls = self.classes[name]
+        with self._lock:
+            if cls["waiters"]:
+                cls["waiters"].popleft().set()  # hand the slot straight over
+            else:
+                cls["busy"]  -= 1
+                self.current -= 1
+
+    def stats(self):
+        counts = self.counts.snapshot()
+        with self._lock:
+            return {name: {"busy": cls["busy"], "limit": cls["limit"],
+                           "waiting": len(cls["waiters"]), "shed_at": cls["shed_at"],
+                           **{event: n for (c, event), n in counts.items() if c == name}}
+                    for name, cls in self.classes.items()}
+
+admission = PriorityAdmission()
+
+def priority_class(path, header):
+    if header:
+        name = header.strip().lower()
+        name = PRIORITY_ALIASES.get(name, name)
+        if name in PRIORITY_CLASSES:
+            return name
+    best = None
+    for prefix in PRIORITY_ROUTES:
+        if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return PRIORITY_ROUTES[best] if best else PRIORITY_DEFAULT
+
+def concurrency_exempt(path, claims):
+    """Whether a request skips the per-instance concurrency limits: only by
+    route class or verified role, never by PRIORITY_HEADER."""
+    if priority_class(path, None) in CONCURRENCY_EXEMPT:
+        return True
+    roles = claims.get("role")
+    roles = roles if isinstance(roles, list) else [roles]
+    return any(role in CONCURRENCY_EXEMPT_ROLES for role in roles if isinstance(role, str))
+
+class AdmissionShed(Exception):
+    """Raised by a fetch that priority admission turned away."""
+
+def shed_response(priority):
+    body = json.dumps({"error": "Load balancer overloaded, retry shortly",
+                       "priority": priority}).encode()
+    return body, 503, {"Retry-After": str(SHED_RETRY_AFTER)}
+
+# ─── Route index ───────────────────────────────────────────────
+class _RouteNode:
+    __slots__ = ("children", "match")
+
+    def __init__(self):
+        self.children = {}
+        self.match    = None    # (service, route) if a route ends here
+
+class RouteIndex:
+    """Segment-aware prefix trie over SERVICE_ROUTES.
+
+    "/reports" matches "/reports" and "/reports/x" but not "/reportsx";
+    when prefixes nest, the longest one wins. Lookup cost depends on the
+    depth of the request path, not on how many routes are registered."""
+
+    def __init__(self, service_routes):
+        self.root = _RouteNode()
+        for svc, routes in service_routes.items():
+            for route in routes:
+                node = self.root
+                for seg in self.segments(route):
+                    node = node.children.setdefault(seg, _RouteNode())
+                if node.match is not None and node.match[0] != svc:
+                    raise ValueError(f"route {route} claimed by both "
+                                     f"{node.match[0]} and {svc}")
+                node.match = (svc, route)
+
+    @staticmethod
+    def segments(path):
+        return [seg for seg in path.split("/") if seg]
+
+    def lookup(self, path):
+        node, best = self.root, self.root.match
+        for seg in path.split("/"):
+            if not seg:
+                continue
+            node = node.children.get(seg)
+            if node is None:
+                break
+            if node.match is not None:
+                best = node.match
+        return best
+
+route_index = RouteIndex(SERVICE_ROUTES)
+
+def rebuild_route_index(service_routes=None):
+    """Recompile the route table; the new index replaces the old one in a
+    single assignment, so concurrent lookups see either one or the other.
+    Passing `service_routes` swaps SERVICE_ROUTES in along with it."""
+    global route_index, SERVICE_ROUTES
+    routes = SERVICE_ROUTES if service_routes is None else service_routes
+    index  = RouteIndex(routes)         # raises before anything is swapped
+    SERVICE_ROUTES, route_index = routes, index
+
+def detect_route(path):
+    """Return (service, matched route prefix), or (None, None)."""
+    return route_index.lookup(path) or (None, None)
+
+def detect_service(path):
+    return detect_route(path)[0]
+
 # ─── Health checker ────────────────────────────────────────────
+# Probes run concurrently on a bounded pool. Each instance has its own
+# schedule: HEALTH_INTERVAL while healthy, and after a failed probe a fast
+# retry starting at HEALTH_MIN_INTERVAL that doubles back up to the normal
+# interval. Proxy traffic also marks instances down passively after
+# PASSIVE_FAIL_THRESHOLD consecutive 5xx/connection failures.
+HEALTH_INTERVAL        = 10     # seconds between probes of a healthy instance
+HEALTH_MIN_INTERVAL    = 1      # first re-probe delay after a failure
+HEALTH_TIMEOUT         = 2
+HEALTH_WORKERS         = 16
+HEALTH_TICK            = 0.25   # scheduler resolution
+PASSIVE_FAIL_THRESHOLD = 3
+
+probe_schedule   = {}           # (service, url) → [next_due, retry_delay]
+probes_in_flight = set()
+probe_lock       = threading.Lock()
+probe_counts     = defaultdict(int) # (service, url) → completed probes
+health_stats     = CounterSet()
+
+def set_instance_health(service_name, url, healthy):
+    svc = SERVICES.get(service_name)
+    if svc is None:
+        return
+    with svc["lock"]:
+        if url not in svc["instances"]:
+            return
+        idx = svc["instances"].index(url)
+        if healthy and not svc["healthy"][idx]:
+            svc["warm_since"][idx] = time.monotonic()
+            svc["current"][idx]    = 0.0
+        svc["healthy"][idx] = healthy
+        if healthy:
+            svc["failures"][idx] = 0
+
+def schedule_probe(service_name, url, delay):
+    """Bring the next probe of an instance forward to at most `delay` from now."""
+    due = time.monotonic() + delay
+    with probe_lock:
+        entry = probe_schedule.setdefault((service_name, url), [due, HEALTH_MIN_INTERVAL])
+        entry[0] = min(entry[0], due)
+
+def probe_instance(service_name, url):
+    try:
+        req = urllib.request.Request(f"{url}/health", method="GET")
+        with urllib.request.urlopen(req, timeout=HEALTH_TIMEOUT):
+            ok = True
+    except Exception:
+        ok = False
+    set_instance_health(service_name, url, ok)
+    with probe_lock:
+        probe_counts[(service_name, url)] += 1
+        health_stats.inc("probes")
+        if not ok:
+            health_stats.inc("probe_failures")
+        entry = probe_schedule.setdefault((service_name, url), [0, HEALTH_MIN_INTERVAL])
+        if ok:
+            entry[0], entry[1] = time.monotonic() + HEALTH_INTERVAL, HEALTH_MIN_INTERVAL
+        else:
+            entry[0], entry[1] = time.monotonic() + entry[1], min(entry[1] * 2, HEALTH_INTERVAL)
+        probes_in_flight.discard((service_name, url))
+
 def health_check_loop():
+    executor   = ThreadPoolExecutor(max_workers=HEALTH_WORKERS, thread_name_prefix="health")
+    next_evict = time.monotonic() + HEALTH_INTERVAL
     while True:
-        for name, svc in SERVICES.items():
-            for i, url in enumerate(svc["instances"]):
-                try:
-                    req = urllib.request.Request(f"{url}/health", method="GET")
-                    with urllib.request.urlopen(req, timeout=2):
-                        svc["healthy"][i] = True
-                except:
-                    svc["healthy"][i] = False
-        time.sleep(10)
+        now, due = time.monotonic(), []
+        with probe_lock:
+            for name, svc in list(SERVICES.items()):
+                for url in list(svc["instances"]):
+                    key   = (name, url)
+                    entry = probe_schedule.setdefault(key, [now, HEALTH_MIN_INTERVAL])
+                    if entry[0] <= now and key not in probes_in_flight:
+                        probes_in_flight.add(key)
+                        due.append(key)
+        for name, url in due:
+            executor.submit(probe_instance, name, url)
+        if now >= next_evict:
+            housekeeping()
+            next_evict = now + HEALTH_INTERVAL
+        time.sleep(HEALTH_TICK)
 
-threading.Thread(target=health_check_loop, daemon=True).start()
+def housekeeping():
+    """Periodic upkeep shared by the health loop and worker sync loop."""
+    for pool in list(pools.values()):
+        pool.evict_idle()
+    expire_registrations()
+    rate_limiter.expire()
 
-# ─── Routes ────────────────────────────────────────────────────
-@app.route("/health")
-def lb_health():
+def start_background_tasks(registry_file=None):
+    threading.Thread(target=health_check_loop, daemon=True).start()
+    threading.Thread(target=access_log.run, daemon=True).start()
+    if registry_file:
+        threading.Thread(target=watch_registry_file, args=(registry_file,), daemon=True).start()
+
+# ─── Dynamic registry ──────────────────────────────────────────
+# Instances can join and leave at runtime through /registry/* or a watched
+# JSON file. Writers are serialised by registry_lock and publish changes by
+# swapping whole objects (a service's instance lists under its lock, or the
+# SERVICES/SERVICE_ROUTES dicts themselves), so a request in flight keeps
+# working with the state it started from. Input is checked in full before
+# anything changes: a bad entry in a registry file rejects the whole file
+# rather than leaving it half applied.
+#
+# The endpoints that change routing (POST /registry/*, POST
+# /services/<name>/strategy) sit on the public proxy port, so they only
+# answer callers on loopback, or, with CHAMA_LB_ADMIN_TOKEN set, callers
+# presenting that token in ADMIN_TOKEN_HEADER.
+REGISTRY_HEARTBEAT_TTL = 30     # seconds an API-registered instance lives without a heartbeat
+REGISTRY_POLL_SECONDS  = 2
+ADMIN_TOKEN            = os.environ.get("CHAMA_LB_ADMIN_TOKEN", "")
+ADMIN_TOKEN_HEADER     = "X-Admin-Token"
+
+registry_lock = threading.RLock()
+registrations = {}              # (service, url) → last heartbeat (monotonic)
+
+def admin_allowed(remote_addr, token):
+    if ADMIN_TOKEN:
+        return token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+    try:
+        return ipaddress.ip_address(remote_addr or "").is_loopback
+    except ValueError:
+        return False
+
+def normalize_instance_url(url):
+    parts = urlsplit(url) if isinstance(url, str) else None
+    if (parts is None or parts.scheme != "http" or not parts.hostname
+            or parts.path not in ("", "/")):
+        raise ValueError(f"instance URL must look like http://host:port, got {url!r}")
+    return f"http://{parts.netloc}"
+
+def check_routes(routes):
+    """`routes` as a list of path prefixes such as "/loans", or ValueError.
+    A bare "/" is refused: it would claim every path no other service has."""
+    if (not isinstance(routes, list) or not routes
+            or not all(isinstance(r, str) and r.startswith("/") and RouteIndex.segments(r)
+                       for r in routes)):
+        raise ValueError(f'routes must be a non-empty list of paths like "/loans", got {routes!r}')
+    return list(routes)
+
+def check_weights(weights):
+    """{normalised url: weight}, or ValueError."""
+    if not isinstance(weights, dict):
+        raise ValueError(f"weights must be a JSON object of url → weight, got {weights!r}")
+    weights = {normalize_instance_url(url): w for url, w in weights.items()}
+    for url, w in weights.items():
+        if isinstance(w, bool) or not isinstance(w, (int, float)) or w <= 0:
+            raise ValueError(f"weight for {url} must be a positive number, got {w!r}")
+    return weights
+
+def set_instances(name, urls):
+    """Replace a service's instance list, carrying per-instance state over
+    by URL so surviving instances keep their health and latency history.
+    New instances start slow."""
+    svc = SERVICES[name]
+    with svc["lock"]:
+        old = {url: i for i, url in enumerate(svc["instances"])}
+        state = {key: [svc[key][old[u]] if u in old else default for u in urls]
+                 for key, default in INSTANCE_STATE.items()}
+        now = time.monotonic()
+        state["warm_since"] = [since if u in old else now
+                               for u, since in zip(urls, state["warm_since"])]
+        svc["instances"] = list(urls)
+        svc.update(state)
+    for url in urls:
+        if url not in old:
+            schedule_probe(name, url, 0)
+
+def ensure_service(name, routes=None, strategy=None):
+    """Create service `name` if needed and update its routes/strategy."""
+    global SERVICES
+    if not isinstance(name, str) or not name:
+        raise ValueError(f"service name must be a non-empty string, got {name!r}")
+    if routes is not None:
+        routes = check_routes(routes)
+    if strategy is not None and strategy not in STRATEGIES:
+        raise ValueError(f"unknown strategy {strategy!r}")
+    with registry_lock:
+        if name not in SERVICES:
+            if not routes:
+                raise ValueError(f"routes are required to register new service {name!r}")
+            svc = {"instances": [], "index": 0, "healthy": []}
+            init_balancer_state(svc)
+            RouteIndex({**SERVICE_ROUTES, name: routes})    # validate first
+            # Publish the service before its routes so a request can never
+            # resolve to a service that is not in SERVICES yet.
+            SERVICES = {**SERVICES, name: svc}
+            rebuild_route_index({**SERVICE_ROUTES, name: routes})
+        elif routes and routes != SERVICE_ROUTES[name]:
+            rebuild_route_index({**SERVICE_ROUTES, name: routes})
+        if strategy is not None:
+            with SERVICES[name]["lock"]:
+                SERVICES[name]["strategy"] = strategy
+        return SERVICES[name]
+
+def set_weights(name, weights):
+    """Set capacity weights for some of a service's instances, by URL."""
+    weights = check_weights(weights)
+    svc = SERVICES[name]
+    with svc["lock"]:
+        svc["weight"] = [weights.get(url, w) for url, w in zip(svc["instances"], svc["weight"])]
+
+def register_instance(name, url, routes=None, weight=None):
+    url = normalize_instance_url(url)
+    if weight is not None:
+        check_weights({url: weight})
+    with registry_lock:
+        svc = ensure_service(name, routes)
+        registrations[(name, url)] = time.monotonic()
+        if url not in svc["instances"]:
+            set_instances(name, svc["instances"] + [url])
+        if weight is not None:
+            set_weights(name, {url: weight})
+    return url
+
+def deregister_instance(name, url):
+    url = normalize_instance_url(url)
+    with registry_lock:
+        registrations.pop((name, url), None)
+        svc = SERVICES.get(name)
+        if svc is None or url not in svc["instances"]:
+            return False
+        set_instances(name, [u for u in svc["instances"] if u != url])
+    return True
+
+def heartbeat_instance(name, url):
+    url = normalize_instance_url(url)
+    with registry_lock:
+        if (name, url) not in registrations:
+            return False
+        registrations[(name, url)] = time.monotonic()
+    return True
+
+def expire_registrations():
+    cutoff = time.monotonic() - REGISTRY_HEARTBEAT_TTL
+    with registry_lock:
+        for (name, url), seen in list(registrations.items()):
+            if seen < cutoff:
+                print(f"[LB] registry: {name} {url} missed heartbeats, removing")
+                deregister_instance(name, url)
+
+def parse_registry_config(config):
+    """Check a registry file document in full. Returns {service: entry}
+    with every field normalised, or raises ValueError."""
+    services = config.get("services", {}) if isinstance(config, dict) else None
+    if not isinstance(services, dict):
+        raise ValueError('registry file must be a JSON object with a "services" object')
+    parsed = {}
+    for name, entry in services.items():
+        if not isinstance(entry, dict):
+            raise ValueError(f"entry for service {name!r} must be a JSON object")
+        checked = {}
+        if entry.get("routes") is not None:
+            checked["routes"] = check_routes(entry["routes"])
+        elif name not in SERVICES:
+            raise ValueError(f"routes are required to register new service {name!r}")
+        if entry.get("strategy") is not None:
+            if entry["strategy"] not in STRATEGIES:
+                raise ValueError(f"unknown strategy {entry['strategy']!r} for {name}")
+            checked["strategy"] = entry["strategy"]
+        if "instances" in entry:
+            if not isinstance(entry["instances"], list):
+                raise ValueError(f"instances for {name} must be a list of URLs")
+            checked["instances"] = [normalize_instance_url(u) for u in entry["instances"]]
+        if "weights" in entry:
+            checked["weights"] = check_weights(entry["weights"])
+        if "slow_start" in entry:
+            slow_start = entry["slow_start"]
+            if (isinstance(slow_start, bool) or not isinstance(slow_start, (int, float))
+                    or slow_start < 0):
+                raise ValueError(f"slow_start for {name} must be a number of seconds, "
+                                 f"got {slow_start!r}")
+            checked["slow_start"] = float(slow_start)
+        parsed[name] = checked
+    RouteIndex({**SERVICE_ROUTES, **{name: entry["routes"] for name, entry in parsed.items()
+                                     if "routes" in entry}})     # route clashes
+    return parsed
+
+def apply_registry_config(config):
+    """Reconcile services listed in a registry file. Each entry may give
+    "instances", "routes", "strategy", "weights" ({url: weight}) and
+    "slow_start" (seconds); API-registered instances of a listed service
+    are kept, anything else not in the file is removed. Nothing is applied
+    unless the whole file checks out."""
+    global SERVICES
+    with registry_lock:
+        parsed = parse_registry_config(config)
+        added  = {}
+        for name in parsed:
+            if name not in SERVICES:
+                added[name] = {"instances": [], "index": 0, "healthy": []}
+                init_balancer_state(added[name])
+        routes = {**SERVICE_ROUTES, **{name: entry["routes"] for name, entry in parsed.items()
+                                       if "routes" in entry}}
+        # Services first, then routes, as in ensure_service.
+        SERVICES = {**SERVICES, **added}
+        if routes != SERVICE_ROUTES:
+            rebuild_route_index(routes)
+        for name, entry in parsed.items():
+            svc = SERVICES[name]
+            if "strategy" in entry:
+                with svc["lock"]:
+                    svc["strategy"] = entry["strategy"]
+            if "instances" in entry:
+                wanted  = list(entry["instances"])
+                wanted += [u for (n, u) in registrations if n == name and u not in wanted]
+                if wanted != svc["instances"]:
+                    set_instances(name, wanted)
+            if "weights" in entry:
+                set_weights(name, entry["weights"])
+            if "slow_start" in entry:
+                svc["slow_start"] = entry["slow_start"]
+
+def watch_registry_file(path):
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime is not None and mtime != last_mtime:
+            last_mtime = mtime
+            try:
+                with open(path) as f:
+                    apply_registry_config(json.load(f))
+                print(f"[LB] registry: loaded {path}")
+            except Exception as e:        # keep watching whatever the file holds
+                print(f"[LB] registry: could not load {path}: {e}")
+        time.sleep(REGISTRY_POLL_SECONDS)
+
+# ─── Shared request bookkeeping ────────────────────────────────
+def health_payload():
     svc_status = {}
     for name, svc in SERVICES.items():
         svc_status[name] = {
@@ -94,76 +2216,1574 @@ def lb_health():
             "healthy":   sum(svc["healthy"]),
             "urls":      svc["instances"]
         }
-    return jsonify({
+    return {
         "service": "Chama Load Balancer",
         "status":  "UP",
         "port":    5000,
         "services": svc_status,
-        "metrics": {
-            "total_requests": metrics["total_requests"],
-            "successful":     metrics["successful"],
-            "failed":         metrics["failed"],
-            "requests_per_service": dict(metrics["requests_per_svc"]),
-            "uptime_since":   metrics["start_time"]
-        }
-    })
+        "metrics": request_totals(),
+        "health_checks": dict(health_stats.snapshot()),
+        "latency_ms": latency_windows("services"),
+        "access_log": access_log.stats(),
+        "compression": compression_stats(),
+        "auth": auth_stats(),
+        "rate_limiting": limits_stats(),
+        "response_cache": response_cache.stats(),
+        "coalescing": dict(coalesce_stats.snapshot()),
+        "hedging": dict(hedge_stats.snapshot()),
+        "batching": dict(batch_stats.snapshot()),
+        "deadlines_exceeded": {route: n for (_, route), n in deadline_counts.snapshot().items()},
+        "circuit_breakers": dict(breaker_stats.snapshot()),
+        "concurrency_limits": dict(concurrency_stats.snapshot()),
+        "connection_pools": {url: pool.stats() for url, pool in list(pools.items())},
+        "async_connection_pools": {url: pool.stats() for url, pool in list(async_pools.items())},
+        "workers": workers_payload() if shared_regions is not None else None
+    }
 
-@app.route("/services")
-def list_services():
+def request_totals():
+    totals = {"total_requests": 0, "successful": 0, "failed": 0}
+    per_service = defaultdict(int)
+    for key, n in request_count_snapshot().items():
+        totals["total_requests"] += n
+        if key[0] == "proxied":
+            per_service[key[1]] += n
+            totals["successful" if key[3] < 400 else "failed"] += n
+    totals["requests_per_service"] = dict(per_service)
+    totals["uptime_since"] = START_TIME
+    return totals
+
+def services_payload():
+    per_service = request_totals()["requests_per_service"]
+    totals      = shared_outstanding() if shared_regions is not None else None
     result = {}
     for name, svc in SERVICES.items():
-        result[name] = {
-            "instances": svc["instances"],
-            "healthy":   svc["healthy"],
-            "routes":    SERVICE_ROUTES[name],
-            "requests":  metrics["requests_per_svc"][name]
-        }
-    return jsonify({"success": True, "load_balancer": "Round-Robin", "services": result})
+        with svc["lock"]:
+            if totals is None:
+                outstanding = list(svc["outstanding"])
+            else:
+                outstanding = [totals.get(name, {}).get(url, 0) for url in svc["instances"]]
+            now = time.monotonic()
+            result[name] = {
+                "instances":   svc["instances"],
+                "healthy":     svc["healthy"],
+                "strategy":    svc["strategy"],
+                "outstanding": outstanding,
+                "weights":     svc["weight"],
+                "effective_weights": [round(effective_weight(svc, i, now), 3)
+                                      for i in range(len(svc["instances"]))],
+                "slow_start_s": svc.get("slow_start", SLOW_START_SECONDS),
+                "ewma_ms":     [round(e, 2) if e is not None else None for e in svc["ewma_ms"]],
+                "breakers":    [get_breaker(url).snapshot() for url in svc["instances"]],
+                "concurrency": [get_limiter(url).snapshot() for url in svc["instances"]],
+                "waiting_for_slot": len(svc["slot_waiters"]),
+                "routes":      SERVICE_ROUTES.get(name, []),
+                "timeouts":    {route: ROUTE_TIMEOUTS.get(route, UPSTREAM_TIMEOUT)
+                                for route in SERVICE_ROUTES.get(name, [])},
+                "requests":    per_service.get(name, 0)
+            }
+    return {"success": True, "load_balancer": "Per-service strategy",
+            "strategies": list(STRATEGIES), "services": result}
+
+def not_found_payload(full_path):
+    return {"error": f"No service found for path: {full_path}",
+            "available_paths": list(SERVICE_ROUTES.keys())}
+
+def request_count_snapshot():
+    if shared_regions is not None:
+        return shared_request_counts()
+    return request_counts.snapshot()
+
+def record_unrouted():
+    request_counts.inc(("unrouted",))
+
+def record_cache_hit(svc_name, route, status):
+    request_counts.inc(("proxied", svc_name, route, status))
+    cache_hit_counts.inc(svc_name)
+
+def record_result(svc_name, route, elapsed, status):
+    get_histogram(latency_by_service, svc_name).record(elapsed)
+    get_histogram(latency_by_route, route).record(elapsed)
+    request_counts.inc(("proxied", svc_name, route, status))
+
+# ─── Prometheus exposition ─────────────────────────────────────
+cache_hit_counts = CounterSet()
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(**labels):
+    body = ",".join(f'{k}="{_label_value(v)}"' for k, v in labels.items())
+    return "{" + body + "}" if body else ""
+
+def prometheus_text():
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{_labels(**labels)} {value}")
+
+    counts = request_count_snapshot()
+    family("chama_lb_requests_total", "counter",
+           "Requests handled by the load balancer, by service, route and status.",
+           [({"service": k[1], "route": k[2], "status": k[3]}, n)
+            for k, n in sorted(counts.items()) if k[0] == "proxied"])
+    family("chama_lb_unrouted_requests_total", "counter",
+           "Requests that matched no service route.",
+           [({}, counts.get(("unrouted",), 0))])
+    family("chama_lb_cache_hits_total", "counter",
+           "Requests answered from the response cache.",
+           [({"service": svc}, n) for svc, n in sorted(cache_hit_counts.snapshot().items())])
+    compressed = compression_counts.snapshot()
+    family("chama_lb_compression_bytes_in_total", "counter",
+           "Response bytes fed to gzip at the LB.", [({}, compressed.get("bytes_in", 0))])
+    family("chama_lb_compression_bytes_out_total", "counter",
+           "Gzipped response bytes sent by the LB.", [({}, compressed.get("bytes_out", 0))])
+    family("chama_lb_compression_cpu_seconds_total", "counter",
+           "Thread CPU time spent gzipping responses.",
+           [({}, compressed.get("cpu_us", 0) / 1e6)])
+    limits = limit_counts.snapshot()
+    family("chama_lb_rate_limited_total", "counter",
+           "Requests rejected with 429 by a client or route token bucket.",
+           [({"scope": k[1]}, n) for k, n in sorted(limits.items()) if k[0] == "rate_limited"])
+    if token_verifier is not None:
+        auth = token_verifier.stats()
+        family("chama_lb_auth_tokens_total", "counter",
+               "Bearer tokens checked at the edge, by outcome.",
+               [({"result": "cache_hit"}, auth["cache_hits"]),
+                ({"result": "verified"}, auth["verified"]),
+                ({"result": "missing"}, auth["missing"])]
+               + [({"result": "rejected", "reason": reason}, n)
+                  for reason, n in sorted(auth["rejected"].items())])
+    classes = admission.stats()
+    family("chama_lb_shed_total", "counter",
+           "Requests rejected with 503 by priority admission (overload or queue timeout).",
+           [({"priority": name}, cls.get("shed", 0) + cls.get("timed_out", 0))
+            for name, cls in classes.items()])
+    family("chama_lb_deadline_exceeded_total", "counter",
+           "Proxied requests that ran out of their route's time budget (answered 504).",
+           [({"service": k[0], "route": k[1]}, n)
+            for k, n in sorted(deadline_counts.snapshot().items())])
+    family("chama_lb_hedged_requests_total", "counter",
+           "Duplicate requests sent to a second instance after the hedge delay.",
+           [({}, hedge_stats.snapshot()["hedges"])])
+    family("chama_lb_in_flight", "gauge",
+           "Proxied requests currently waiting on an upstream, by priority class.",
+           [({"priority": name}, cls["busy"]) for name, cls in classes.items()])
+    limits, waiting = [], []
+    for svc_name, svc in SERVICES.items():
+        with svc["lock"]:
+            limits  += [({"service": svc_name, "instance": url}, round(get_limiter(url).limit, 1))
+                        for url in svc["instances"]]
+            waiting.append(({"service": svc_name}, len(svc["slot_waiters"])))
+    family("chama_lb_instance_concurrency_limit", "gauge",
+           "Adaptive limit on concurrent requests sent to an instance.", limits)
+    family("chama_lb_instance_slot_waiters", "gauge",
+           "Requests queued for a slot because every instance is at its limit.", waiting)
+    quantiles = [("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")]
+    for name, kind, label in (("chama_lb_service_latency_ms", "services", "service"),
+                              ("chama_lb_route_latency_ms", "routes", "route")):
+        samples = []
+        for key, windows in sorted(latency_windows(kind).items()):
+            summary = windows["1m"]
+            samples += [({label: key, "quantile": q}, summary[field])
+                        for q, field in quantiles if summary[field] is not None]
+            samples.append(({label: key, "quantile": "1"}, summary["max"] or 0))
+        family(name, "gauge", f"Proxy latency quantiles per {label} over the last minute.", samples)
+    instance_samples, breaker_samples = [], []
+    for name, svc in list(SERVICES.items()):
+        with svc["lock"]:
+            for url, ok in zip(svc["instances"], svc["healthy"]):
+                instance_samples.append(({"service": name, "instance": url}, int(ok)))
+                open_ = get_breaker(url).snapshot()["state"] != CircuitBreaker.CLOSED
+                breaker_samples.append(({"service": name, "instance": url}, int(open_)))
+    family("chama_lb_instance_healthy", "gauge", "1 if the instance is marked healthy.",
+           instance_samples)
+    family("chama_lb_circuit_open", "gauge", "1 if the instance's circuit breaker is not closed.",
+           breaker_samples)
+    return "\n".join(lines) + "\n"
+
+def lb_headers(svc_name, elapsed):
+    return {"X-Served-By": svc_name,
+            "X-Response-Time": f"{elapsed}ms",
+            "X-Load-Balancer": "Chama-LB-v1"}
+
+# ─── Response compression ──────────────────────────────────────
+# Responses are gzipped at the LB when the client accepts gzip, the body
+# is at least GZIP_MIN_BYTES and the content type is textual. Bodies the
+# upstream already encoded are passed through untouched.
+GZIP_MIN_BYTES = 1024
+GZIP_LEVEL     = 5
+GZIP_TYPES     = ("application/json", "application/javascript", "application/xml", "text/")
+
+compression_counts = CounterSet()   # bytes_in, bytes_out, cpu_us, responses, passthrough
+
+def header_value(headers, name, default=None):
+    """Case-insensitive lookup in a plain dict of headers."""
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value
+    return default
+
+def accepts_gzip(accept_encoding):
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        params = params.strip().replace(" ", "")
+        if params.startswith("q="):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+def _record_compression(size_in, size_out, cpu_seconds):
+    compression_counts.inc("bytes_in", size_in)
+    compression_counts.inc("bytes_out", size_out)
+    compression_counts.inc("cpu_us", int(cpu_seconds * 1e6))
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)    # 31 → gzip container
+    try:
+        for chunk in chunks:
+            began = time.thread_time()
+            out   = compressor.compress(chunk)
+            _record_compression(len(chunk), len(out), time.thread_time() - began)
+            if out:
+                yield out
+        tail = compressor.flush()
+        compression_counts.inc("bytes_out", len(tail))
+        yield tail
+    finally:
+        chunks.close()
+
+async def gzip_chunks_async(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    try:
+        async for chunk in chunks:
+            began = time.thread_time()
+            out   = compressor.compress(chunk)
+            _record_compression(len(chunk), len(out), time.thread_time() - began)
+            if out:
+                yield out
+        tail = compressor.flush()
+        compression_counts.inc("bytes_out", len(tail))
+        yield tail
+    finally:
+        await chunks.aclose()
+
+def compress_response(data, status, content_type, upstream_headers, accept_encoding):
+    """Return (data, headers to add, dropped Content-Length?) for the client."""
+    encoding = header_value(upstream_headers, "Content-Encoding")
+    if encoding and encoding.lower() != "identity":
+        compression_counts.inc("passthrough")
+        return data, {"Content-Encoding": encoding}, False
+    mime = (content_type or "").split(";")[0].strip().lower()
+    if (status < 200 or status in (204, 304) or not accepts_gzip(accept_encoding)
+            or not mime.startswith(GZIP_TYPES)):
+        return data, {}, False
+    gzip_headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+    if isinstance(data, bytes):
+        if len(data) < GZIP_MIN_BYTES:
+            return data, {}, False
+        began = time.thread_time()
+        out   = gzip.compress(data, GZIP_LEVEL)
+        _record_compression(len(data), len(out), time.thread_time() - began)
+        if len(out) >= len(data):
+            return data, {}, False
+        compression_counts.inc("responses")
+        return out, gzip_headers, False
+    compression_counts.inc("responses")
+    if hasattr(data, "__aiter__"):
+        return gzip_chunks_async(data), gzip_headers, True
+    return gzip_chunks(data), gzip_headers, True
+
+def compression_stats():
+    counts = compression_counts.snapshot()
+    return {"responses": counts.get("responses", 0),
+            "passthrough": counts.get("passthrough", 0),
+            "bytes_in": counts.get("bytes_in", 0),
+            "bytes_out": counts.get("bytes_out", 0),
+            "bytes_saved": counts.get("bytes_in", 0) - counts.get("bytes_out", 0),
+            "cpu_ms": round(counts.get("cpu_us", 0) / 1000, 2)}
+
+# ─── Request tracing ───────────────────────────────────────────
+# Every proxied request carries an X-Request-ID (the client's, if it sent a
+# sane one) to the upstream and back, and is timed per stage: route lookup,
+# instance selection, connect (pool wait plus TCP connect, ~0 on a reused
+# socket), time to first byte and body transfer. The breakdown is returned
+# in a Server-Timing header and kept in a bounded ring of recent requests
+# that /requests/slowest sorts on demand. A streamed body's transfer time is
+# filled in when the relay finishes, after the request has been recorded.
+TRACE_BUFFER       = 2048           # recent requests kept for /requests/slowest
+TRACE_STAGES       = ("route", "select", "connect", "ttfb", "transfer")
+REQUEST_ID_MAX_LEN = 128
+
+class RequestTraces:
+    def __init__(self, size=TRACE_BUFFER):
+        self._ring = deque(maxlen=size)
+
+    def record(self, request_id, method, path, service, upstream, status, total_ms,
+               stages, coalesced=False):
+        self._ring.append({"request_id": request_id, "ts": time.time(), "method": method,
+                           "path": path, "service": service, "upstream": upstream,
+                           "status": status, "total_ms": total_ms, "stages": stages,
+                           "coalesced": coalesced})
+
+    def slowest(self, limit=20, service=None):
+        entries = [e for e in list(self._ring) if service is None or e["service"] == service]
+        slowest = sorted(entries, key=lambda e: e["total_ms"], reverse=True)[:limit]
+        # A streamed body's relay may still be adding its transfer time.
+        return [{**e, "stages": dict(e["stages"])} for e in slowest]
+
+    def __len__(self):
+        return len(self._ring)
+
+request_traces = RequestTraces()
+
+def request_id_for(incoming):
+    """Propagate a client's X-Request-ID if it is safe to echo, else mint one."""
+    if (incoming and len(incoming) <= REQUEST_ID_MAX_LEN
+            and incoming.isascii() and incoming.isprintable()):
+        return incoming
+    return uuid.uuid4().hex
+
+def stage_mark(trace, stage, since):
+    """Add the ms elapsed since `since` (a perf_counter reading) to
+    trace[stage] and return the current reading; a no-op without a trace."""
+    now = time.perf_counter()
+    if trace is not None:
+        trace[stage] = round(trace.get(stage, 0) + (now - since) * 1000, 3)
+    return now
+
+def server_timing(stages, total_ms):
+    parts = [f"{stage};dur={stages[stage]}" for stage in TRACE_STAGES if stage in stages]
+    return ", ".join(parts + [f"total;dur={total_ms}"])
+
+def trace_headers(request_id, stages, total_ms):
+    return {"X-Request-ID": request_id, "Server-Timing": server_timing(stages, total_ms)}
+
+# ─── Access log ────────────────────────────────────────────────
+# Request threads only append a small dict to an in-memory buffer; a
+# background writer turns batches into JSON lines and appends them to a
+# size-rotated file. When the buffer is full new records are dropped and
+# counted rather than blocking the request. Every response the proxy path
+# sends is logged, not only those that reached an upstream; "outcome" says
+# which: unrouted, unauthorized, rate_limited, deadline, cache_hit, shed,
+# no_instance or upstream. "ms" is upstream time for upstream responses and
+# time spent in the LB otherwise.
+ACCESS_LOG_PATH          = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lb_access.log")
+ACCESS_LOG_SAMPLE_RATE   = 1.0      # fraction of non-5xx requests logged; 5xx always are
+ACCESS_LOG_BUFFER        = 10000    # records held before dropping
+ACCESS_LOG_BATCH         = 500
+ACCESS_LOG_FLUSH_SECONDS = 1.0
+ACCESS_LOG_MAX_BYTES     = 10 * 1024 * 1024
+ACCESS_LOG_BACKUPS       = 5
+
+class AccessLog:
+    def __init__(self, path=ACCESS_LOG_PATH, sample_rate=ACCESS_LOG_SAMPLE_RATE):
+        self.path        = path
+        self.sample_rate = sample_rate
+        self._buffer     = deque()
+        self.counts      = CounterSet()     # hot-path counters
+        self.counters    = defaultdict(int) # writer-thread counters
+
+    def log(self, status, **fields):
+        if not self.path:
+            return
+        if status < 500 and self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.counts.inc("sampled_out")
+            return
+        if len(self._buffer) >= ACCESS_LOG_BUFFER:
+            self.counts.inc("dropped")
+            return
+        fields["ts"], fields["status"] = time.time(), status
+        self._buffer.append(fields)
+        self.counts.inc("enqueued")
+
+    def flush(self):
+        while self._buffer:
+            batch = []
+            while self._buffer and len(batch) < ACCESS_LOG_BATCH:
+                batch.append(self._buffer.popleft())
+            lines = []
+            for record in batch:
+                record["ts"] = datetime.fromtimestamp(record["ts"]).isoformat(timespec="milliseconds")
+                lines.append(json.dumps(record, separators=(",", ":"), default=str))
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+                    size = f.tell()
+            except OSError:
+                self.counters["write_errors"] += 1
+                self.counters["lost"] += len(batch)
+                continue
+            self.counters["written"] += len(batch)
+            self.counters["batches"] += 1
+            if size >= ACCESS_LOG_MAX_BYTES:
+                self.rotate()
+
+    def rotate(self):
+        for n in range(ACCESS_LOG_BACKUPS - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self.counters["rotations"] += 1
+
+    def run(self):
+        while True:
+            time.sleep(ACCESS_LOG_FLUSH_SECONDS)
+            self.flush()
+
+    def stats(self):
+        return {"path": self.path, "sample_rate": self.sample_rate,
+                "buffered": len(self._buffer), **self.counts.snapshot(), **self.counters}
+
+access_log = AccessLog()
+
+# ─── Batch requests ────────────────────────────────────────────
+# POST /batch {"requests": [{"id", "method", "path", "headers", "body"}, ...]}
+# runs up to BATCH_MAX_ITEMS sub-requests concurrently through the normal
+# proxy path (so rate limits, cache, admission, retries and tracing apply
+# to each) and answers with one document holding every item's status,
+# timing and body. A dashboard or USSD menu then costs a mobile client one
+# round trip instead of five. Items inherit BATCH_INHERITED_HEADERS from the
+# batch and are traced as "<batch request id>.<n>".
+BATCH_MAX_ITEMS         = 16
+BATCH_WORKERS           = 32    # Flask engine threads running batch items
+BATCH_INHERITED_HEADERS = ("Authorization", "X-Member-ID", PRIORITY_HEADER, DEADLINE_HEADER)
+BATCH_RESULT_HEADERS    = ("X-Request-ID", "X-Served-By", "X-Cache", "X-Coalesced", "Retry-After")
+
+batch_stats    = CounterSet()
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+
+def batch_items(payload, headers_lower, request_id):
+    """Validate a batch document. Returns (items, error): each item is
+    either (id, method, target, headers, body) or (id, status, message)."""
+    entries = payload.get("requests") if isinstance(payload, dict) else None
+    if not isinstance(entries, list) or not entries:
+        return None, 'body must be a JSON object with a non-empty "requests" list'
+    if len(entries) > BATCH_MAX_ITEMS:
+        return None, f"at most {BATCH_MAX_ITEMS} requests per batch"
+    inherited = {name: headers_lower[name.lower()] for name in BATCH_INHERITED_HEADERS
+                 if name.lower() in headers_lower}
+    items = []
+    for n, entry in enumerate(entries):
+        if not isinstance(entry, dict):
+            items.append((str(n), 400, "each request must be a JSON object"))
+            continue
+        item_id = str(entry.get("id", n))
+        method  = str(entry.get("method", "GET")).upper()
+        target  = entry.get("path")
+        extra   = entry.get("headers") or {}
+        if not isinstance(target, str) or not target.startswith("/"):
+            items.append((item_id, 400, "path must be a string starting with /"))
+        elif method not in PROXY_METHODS:
+            items.append((item_id, 405, f"Method {method} not allowed"))
+        elif not isinstance(extra, dict):
+            items.append((item_id, 400, "headers must be a JSON object"))
+        else:
+            headers = {**inherited, **{str(k): str(v) for k, v in extra.items()},
+                       "X-Request-ID": f"{request_id}.{n}"}
+            body = entry.get("body")
+            if isinstance(body, str):
+                body = body.encode()
+            elif body is not None:
+                body = json.dumps(body).encode()
+                if header_value(headers, "Content-Type") is None:
+                    headers["Content-Type"] = "application/json"
+            items.append((item_id, method, target, headers, body))
+    return items, None
+
+def batch_result(item_id, status, headers, data, elapsed):
+    content_type = header_value(headers, "Content-Type", "")
+    result = {"id": item_id, "status": status, "elapsed_ms": elapsed,
+              "headers": {name: value for name in BATCH_RESULT_HEADERS
+                          if (value := header_value(headers, name)) is not None}}
+    text = data.decode("utf-8", "replace")
+    if content_type.split(";")[0].strip().lower() == "application/json":
+        try:
+            result["body"] = json.loads(text)
+            return result
+        except ValueError:
+            pass
+    result["body"] = text
+    return result
+
+def batch_error(item_id, status, message):
+    return {"id": item_id, "status": status, "elapsed_ms": 0.0, "error": message}
+
+def batch_response(request_id, results, started, accept_encoding):
+    """(status, headers, body) for the combined batch document."""
+    batch_stats.inc("batches")
+    batch_stats.inc("items", len(results))
+    batch_stats.inc("failed_items", sum(r["status"] >= 400 for r in results))
+    elapsed = round((time.perf_counter() - started) * 1000, 2)
+    data    = json.dumps({"success": True, "request_id": request_id,
+                          "elapsed_ms": elapsed, "responses": results}).encode()
+    data, extra, _ = compress_response(data, 200, "application/json", {}, accept_encoding)
+    return 200, {"Content-Type": "application/json", "X-Request-ID": request_id,
+                 "X-Response-Time": f"{elapsed}ms", **extra}, data
+
+# ─── Multi-process workers ─────────────────────────────────────
+# With --workers N the parent forks N serving processes that each bind
+# port 5000 with SO_REUSEPORT, so the kernel spreads connections across
+# them and the GIL of one process no longer caps the LB at one core. The
+# parent keeps probing instances and watching the registry file; state is
+# exchanged through an anonymous shared mmap split into one fixed-size
+# region per process. Each region holds a JSON document behind a seqlock
+# (the sequence is odd while its single writer is mid-update, and readers
+# retry on an odd or changed sequence): region 0 is the parent's instance
+# health, region n is worker n's request counts, histogram buckets and
+# in-flight counts, which the read-side views merge.
+SHM_REGION_BYTES    = 256 * 1024
+SHM_PUBLISH_SECONDS = 1
+SHM_HEADER          = struct.Struct("QI")   # sequence, payload length
+
+shared_regions = None           # SharedRegions when running with --workers
+worker_id      = None           # 1..N inside a worker process
+worker_stats   = defaultdict(int)
+
+class SharedRegions:
+    def __init__(self, count, size=SHM_REGION_BYTES):
+        self.count = count
+        self.size  = size
+        self._mem  = mmap.mmap(-1, count * size)
+
+    def publish(self, index, doc):
+        """Write `doc` to region `index`; only one process may write a region."""
+        data = json.dumps(doc, separators=(",", ":")).encode()
+        if len(data) > self.size - SHM_HEADER.size:
+            return False
+        base   = index * self.size
+        start  = base + SHM_HEADER.size
+        seq, _ = SHM_HEADER.unpack_from(self._mem, base)
+        SHM_HEADER.pack_into(self._mem, base, seq + 1, len(data))
+        self._mem[start:start + len(data)] = data
+        SHM_HEADER.pack_into(self._mem, base, seq + 2, len(data))
+        return True
+
+    def read(self, index, retries=100):
+        base  = index * self.size
+        start = base + SHM_HEADER.size
+        for _ in range(retries):
+            seq, length = SHM_HEADER.unpack_from(self._mem, base)
+            if seq == 0:
+                return None
+            if seq % 2 == 0:
+                data = self._mem[start:start + length]
+                if SHM_HEADER.unpack_from(self._mem, base)[0] == seq:
+                    return json.loads(data)
+            time.sleep(0)
+        return None
+
+def health_snapshot():
+    """Parent → workers: {service: {url: [healthy, completed probes]}}."""
+    with probe_lock:
+        counts = dict(probe_counts)
+    result = {}
+    for name, svc in list(SERVICES.items()):
+        with svc["lock"]:
+            result[name] = {url: [ok, counts.get((name, url), 0)]
+                            for url, ok in zip(svc["instances"], svc["healthy"])}
+    return {"ts": time.time(), "pid": os.getpid(), "health": result}
+
+def worker_snapshot():
+    """Worker → readers: counters, sparse histogram buckets and in-flight counts."""
+    latency = {}
+    for kind, table in (("services", latency_by_service), ("routes", latency_by_route)):
+        latency[kind] = {}
+        for key, hist in list(table.items()):
+            windows = {}
+            for window, seconds in LATENCY_WINDOWS.items():
+                counts, max_ms = hist.merged(seconds)
+                windows[window] = [[i, c] for i, c in enumerate(counts) if c], max_ms
+            latency[kind][key] = windows
+    outstanding = {}
+    for name, svc in list(SERVICES.items()):
+        with svc["lock"]:
+            outstanding[name] = dict(zip(svc["instances"], svc["outstanding"]))
+    return {"ts": time.time(), "pid": os.getpid(),
+            "requests": [[list(key), n] for key, n in request_counts.snapshot().items()],
+            "latency": latency, "outstanding": outstanding}
+
+def worker_docs():
+    """Every worker's latest snapshot, with this worker's own taken live."""
+    docs = {}
+    for n in range(1, shared_regions.count):
+        doc = worker_snapshot() if n == worker_id else shared_regions.read(n)
+        if doc is not None:
+            docs[n] = doc
+    return docs
+
+def shared_request_counts():
+    totals = defaultdict(int)
+    for doc in worker_docs().values():
+        for key, n in doc["requests"]:
+            totals[tuple(key)] += n
+    return dict(totals)
+
+def shared_latency_windows(kind):
+    merged = {}
+    for doc in worker_docs().values():
+        for key, windows in doc["latency"][kind].items():
+            entry = merged.setdefault(key, {w: [[0] * HIST_BUCKETS, 0.0] for w in LATENCY_WINDOWS})
+            for window, (buckets, max_ms) in windows.items():
+                counts = entry[window][0]
+                for i, c in buckets:
+                    counts[i] += c
+                entry[window][1] = max(entry[window][1], max_ms)
+    return {key: {w: LatencyHistogram.summarize(*entry[w]) for w in LATENCY_WINDOWS}
+            for key, entry in merged.items()}
+
+def shared_outstanding():
+    totals = defaultdict(lambda: defaultdict(int))
+    for doc in worker_docs().values():
+        for name, per_url in doc["outstanding"].items():
+            for url, n in per_url.items():
+                totals[name][url] += n
+    return totals
+
+def workers_payload():
+    now, result = time.time(), {}
+    for n in range(1, shared_regions.count):
+        doc = shared_regions.read(n)
+        result[n] = ({"pid": doc["pid"], "published_s_ago": round(now - doc["ts"], 2)}
+                     if doc else {"pid": None, "published_s_ago": None})
+    return {"worker_id": worker_id, "count": shared_regions.count - 1, "workers": result,
+            **worker_stats}
+
+def publish_health_loop():
+    while True:
+        if not shared_regions.publish(0, health_snapshot()):
+            health_stats.inc("shm_overflows")
+        time.sleep(SHM_PUBLISH_SECONDS)
+
+def worker_sync_loop():
+    """Adopt the parent's probe results and publish this worker's metrics.
+    A result is applied only once per completed probe, so passive marks made
+    by this worker's own traffic stand until the parent probes again."""
+    applied    = {}
+    next_house = time.monotonic() + HEALTH_INTERVAL
+    while True:
+        doc = shared_regions.read(0)
+        for name, per_url in (doc or {}).get("health", {}).items():
+            for url, (healthy, probes) in per_url.items():
+                if applied.get((name, url)) != probes:
+                    applied[(name, url)] = probes
+                    set_instance_health(name, url, healthy)
+        if not shared_regions.publish(worker_id, worker_snapshot()):
+            worker_stats["shm_overflows"] += 1
+        if time.monotonic() >= next_house:
+            housekeeping()
+            next_house = time.monotonic() + HEALTH_INTERVAL
+        time.sleep(SHM_PUBLISH_SECONDS)
+
+def reuseport_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+def serve_worker(n, use_async, registry_file):
+    global worker_id
+    worker_id = n
+    if access_log.path:
+        root, ext = os.path.splitext(access_log.path)
+        access_log.path = f"{root}.w{n}{ext}"
+    threading.Thread(target=worker_sync_loop, daemon=True).start()
+    threading.Thread(target=access_log.run, daemon=True).start()
+    if registry_file:
+        threading.Thread(target=watch_registry_file, args=(registry_file,), daemon=True).start()
+    if use_async:
+        asyncio.run(serve_async(port=5000, reuse_port=True))
+    else:
+        sock = reuseport_socket("localhost", 5000)
+        make_server("localhost", 5000, app, threaded=True, fd=sock.fileno()).serve_forever()
+
+def run_workers(count, use_async, registry_file):
+    """Fork `count` workers, then probe and publish health until they exit.
+    Forking happens before any thread is started, so children inherit no
+    half-held locks."""
+    global shared_regions
+    shared_regions = SharedRegions(count + 1)
+    children = []
+    for n in range(1, count + 1):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve_worker(n, use_async, registry_file)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                access_log.flush()
+                os._exit(0)
+        children.append(pid)
+        print(f"  worker {n}: pid {pid}")
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    threading.Thread(target=health_check_loop, daemon=True).start()
+    threading.Thread(target=publish_health_loop, daemon=True).start()
+    if registry_file:
+        threading.Thread(target=watch_registry_file, args=(registry_file,), daemon=True).start()
+    try:
+        while children:
+            pid, status = os.wait()
+            if pid in children:
+                children.remove(pid)
+                print(f"  worker pid {pid} exited ({status})")
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+
+# ─── Routes ────────────────────────────────────────────────────
+@app.route("/health")
+def lb_health():
+    return jsonify(health_payload())
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(prometheus_text(), content_type="text/plain; version=0.0.4")
+
+@app.route("/latency")
+def latency():
+    return jsonify(latency_payload())
+
+@app.route("/services")
+def list_services():
+    return jsonify(services_payload())
+
+@app.route("/registry")
+def registry_view():
+    now = time.monotonic()
+    return jsonify({"success": True,
+                    "heartbeat_ttl": REGISTRY_HEARTBEAT_TTL,
+                    "services": {name: svc["instances"] for name, svc in SERVICES.items()},
+                    "registrations": [{"service": name, "url": url,
+                                       "last_heartbeat_s": round(now - seen, 1)}
+                                      for (name, url), seen in list(registrations.items())]})
+
+@app.route("/registry/<action>", methods=["POST"])
+def registry_update(action):
+    if not admin_allowed(request.remote_addr, request.headers.get(ADMIN_TOKEN_HEADER)):
+        return jsonify({"success": False, "error": "registry changes need admin access"}), 403
+    data = request.get_json(silent=True) or {}
+    name, url = data.get("service"), data.get("url")
+    if not name or not url:
+        return jsonify({"success": False, "error": "service and url are required"}), 400
+    try:
+        if action == "register":
+            url = register_instance(name, url, data.get("routes"), data.get("weight"))
+            return jsonify({"success": True, "service": name, "url": url,
+                            "heartbeat_ttl": REGISTRY_HEARTBEAT_TTL}), 201
+        if action == "deregister":
+            if not deregister_instance(name, url):
+                return jsonify({"success": False, "error": f"{url} is not registered for {name}"}), 404
+            return jsonify({"success": True, "service": name, "url": url})
+        if action == "heartbeat":
+            if not heartbeat_instance(name, url):
+                return jsonify({"success": False, "error": "unknown registration; register again"}), 404
+            return jsonify({"success": True, "service": name, "url": url})
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": False, "error": f"Unknown registry action: {action}"}), 404
+
+@app.route("/services/<name>/strategy", methods=["POST"])
+def set_strategy(name):
+    if not admin_allowed(request.remote_addr, request.headers.get(ADMIN_TOKEN_HEADER)):
+        return jsonify({"success": False, "error": "strategy changes need admin access"}), 403
+    strategy = (request.get_json(silent=True) or {}).get("strategy")
+    if name not in SERVICES:
+        return jsonify({"success": False, "error": f"Unknown service: {name}"}), 404
+    if strategy not in STRATEGIES:
+        return jsonify({"success": False, "error": f"Unknown strategy: {strategy}",
+                        "strategies": list(STRATEGIES)}), 400
+    with SERVICES[name]["lock"]:
+        SERVICES[name]["strategy"] = strategy
+    return jsonify({"success": True, "service": name, "strategy": strategy})
+
+@app.route("/batch", methods=["POST"])
+def batch():
+    started    = time.perf_counter()
+    request_id = request_id_for(request.headers.get("X-Request-ID"))
+    req_fields = {k.lower(): v for k, v in request.headers.items()}
+    items, error = batch_items(request.get_json(silent=True, force=True), req_fields, request_id)
+    if error:
+        return jsonify({"success": False, "error": error}), 400
+    remote = request.remote_addr
+
+    def run(item_id, method, target, headers, body):
+        # Each item gets its own request context on a batch thread and goes
+        # through proxy() exactly as a standalone request would. Streamed
+        # bodies are passthrough responses that get_data() refuses, so the
+        # body is drained by hand; closing afterwards hands the upstream
+        # connection back even if draining failed part way.
+        began = time.perf_counter()
+        try:
+            with app.test_request_context(target, method=method, headers=headers, data=body,
+                                          environ_base={"REMOTE_ADDR": remote}):
+                resp = app.make_response(proxy(request.path[1:]))
+                try:
+                    data = b"".join(resp.iter_encoded())
+                finally:
+                    resp.close()
+        except Exception as e:
+            return batch_error(item_id, 502, str(e) or type(e).__name__)
+        return batch_result(item_id, resp.status_code, resp.headers, data,
+                            round((time.perf_counter() - began) * 1000, 2))
+
+    futures = [batch_executor.submit(run, *item) if len(item) == 5 else item for item in items]
+    results = [batch_error(*f) if isinstance(f, tuple) else f.result() for f in futures]
+    status, headers, data = batch_response(request_id, results, started,
+                                           request.headers.get("Accept-Encoding"))
+    return Response(data, status=status, headers=headers)
+
+@app.route("/requests/slowest")
+def slowest_requests():
+    limit   = min(max(request.args.get("limit", 20, type=int), 1), TRACE_BUFFER)
+    service = request.args.get("service")
+    return jsonify({"recorded": len(request_traces), "stages": list(TRACE_STAGES),
+                    "requests": request_traces.slowest(limit, service)})
 
 @app.route("/<path:path>", methods=["GET","POST","PUT","DELETE"])
 def proxy(path):
-    full_path = "/" + path
-    svc_name  = detect_service(full_path)
+    full_path  = "/" + path
+    request_id = request_id_for(request.headers.get("X-Request-ID"))
+    query      = request.query_string.decode()
+    stages     = {}
+    began      = time.perf_counter()
+    svc_name, route = detect_route(full_path)
+    stage_mark(stages, "route", began)
 
-    with lock:
-        metrics["total_requests"] += 1
+    def log(status, outcome, **fields):
+        fields.setdefault("ms", round((time.perf_counter() - began) * 1000, 2))
+        access_log.log(status, outcome=outcome, method=request.method, path=full_path,
+                       query=query, service=svc_name, client=request.remote_addr,
+                       request_id=request_id, **fields)
 
     if not svc_name:
-        return jsonify({"error": f"No service found for path: {full_path}",
-                        "available_paths": list(SERVICE_ROUTES.keys())}), 404
+        record_unrouted()
+        log(404, "unrouted")
+        return jsonify(not_found_payload(full_path)), 404
+
+    claims, denied = authenticate(request.headers.get("Authorization"), route)
+    if denied:
+        data, status, headers = denied
+        log(status, "unauthorized")
+        return Response(data, status=status, content_type="application/json", headers=headers)
+
+    limited = rate_limit(client_key(request.remote_addr, claims), route)
+    if limited:
+        data, status, headers = limited
+        log(status, "rate_limited")
+        return Response(data, status=status, content_type="application/json", headers=headers)
+
+    deadline = request_deadline(route, request.headers.get(DEADLINE_HEADER))
+    if deadline_exceeded(svc_name, route, deadline, 504):
+        data, status, headers = deadline_response()
+        log(status, "deadline")
+        return Response(data, status=status, content_type="application/json", headers=headers)
 
-    base_url    = get_next_instance(svc_name)
-    query       = request.query_string.decode()
-    target_url  = f"{base_url}{full_path}" + (f"?{query}" if query else "")
-    body        = request.get_data() or None
+    req_fields  = {k.lower(): v for k, v in request.headers.items()}
+    identity    = request_identity(request.headers.get("Authorization"), claims)
+    key         = cache_key(request.method, full_path, query, identity)
+    cached      = cache_lookup(key, req_fields)
+    if cached:
+        status, content_type, data = cached
+        record_cache_hit(svc_name, route, status)
+        log(status, "cache_hit")
+        data, extra, _ = compress_response(data, status, content_type, {},
+                                           request.headers.get("Accept-Encoding"))
+        return Response(data, status=status, content_type=content_type,
+                        headers={**cached_response_headers(svc_name), **extra,
+                                 "X-Request-ID": request_id})
+
+    chunked_in  = "chunked" in request.headers.get("Transfer-Encoding", "").lower()
+    if chunked_in or (request.content_length and should_stream(request.content_length)):
+        body, body_length = request.stream, request.content_length
+    else:
+        body, body_length = request.get_data() or None, None
+    priority    = priority_class(full_path, request.headers.get(PRIORITY_HEADER))
+    exempt      = concurrency_exempt(full_path, claims)
     start       = time.time()
 
-    data, status, resp_headers = forward_request(target_url, request.method, dict(request.headers), body)
-    elapsed = round((time.time() - start) * 1000, 2)
+    target      = full_path + (f"?{query}" if query else "")
+    fwd_headers = upstream_headers(request.headers, request_id, deadline, claims)
+    hedge_after = hedge_delay(svc_name, route, request.method, body)
+    routing_key = hash_key(svc_name, full_path, query, req_fields)
+
+    def call_upstream():
+        tried = []
+        retry_budgets[svc_name].deposit()
+        while True:
+            picking  = time.perf_counter()
+            base_url = acquire_instance(svc_name, tried, routing_key, deadline, exempt)
+            stage_mark(stages, "select", picking)
+            if base_url is None:
+                return (None, *no_instance_response(svc_name))
+            tried.append(base_url)
+            if hedge_after is not None and len(tried) == 1:
+                base_url, data, status, resp_headers = forward_hedged(
+                    svc_name, base_url, target, request.method, fwd_headers,
+                    hedge_after, tried, stages, deadline)
+            else:
+                base_url, data, status, resp_headers = forward_attempt(
+                    svc_name, base_url, target, request.method, fwd_headers,
+                    body, body_length, stages, deadline)
+            if (not should_retry(svc_name, request.method, body, len(tried), status, data)
+                    or time_left(deadline) <= 0):
+                return base_url, data, status, resp_headers
 
-    with lock:
-        metrics["requests_per_svc"][svc_name] += 1
-        metrics["response_times"][svc_name].append(elapsed)
-        if status < 400:
-            metrics["successful"] += 1
+    def fetch():
+        if not admission.acquire(priority):
+            raise AdmissionShed(priority)
+        try:
+            return call_upstream()
+        finally:
+            admission.release(priority)
+
+    # For streamed responses elapsed covers the upstream headers only
+    # (time to first byte); the body is relayed after we return.
+    try:
+        if request.method == "GET" and body is None:
+            (base_url, data, status, resp_headers), shared = single_flight.do(
+                (svc_name, full_path, query, identity), fetch, deadline)
         else:
-            metrics["failed"] += 1
+            (base_url, data, status, resp_headers), shared = fetch(), False
+    except AdmissionShed:
+        data, status, headers = shed_response(priority)
+        log(status, "shed")
+        return Response(data, status=status, content_type="application/json", headers=headers)
+    elapsed = round((time.time() - start) * 1000, 2)
 
-    print(f"[LB] {request.method} {full_path} → {svc_name} ({base_url}) | {status} | {elapsed}ms")
+    record_result(svc_name, route, elapsed, status)
+    deadline_exceeded(svc_name, route, deadline, status)
+    if request.method in WRITE_METHODS:
+        response_cache.invalidate_service(svc_name)
+    if not shared:
+        cache_store(key, svc_name, req_fields, status, resp_headers, data)
+
+    request_traces.record(request_id, request.method, full_path, svc_name, base_url, status,
+                          elapsed, stages, shared)
+    log(status, "upstream" if base_url else "no_instance", upstream=base_url, ms=elapsed,
+        coalesced=shared)
 
     content_type = resp_headers.get("Content-Type","application/json")
-    return Response(data, status=status, content_type=content_type,
-                    headers={"X-Served-By": svc_name,
-                             "X-Response-Time": f"{elapsed}ms",
-                             "X-Load-Balancer": "Chama-LB-v1"})
+    headers      = {**lb_headers(svc_name, elapsed), **trace_headers(request_id, stages, elapsed)}
+    if key is not None:
+        headers["X-Cache"] = "MISS"
+    if shared:
+        headers["X-Coalesced"] = "1"
+    data, extra, length_dropped = compress_response(
+        data, status, content_type, resp_headers, request.headers.get("Accept-Encoding"))
+    headers.update(extra)
+    if not isinstance(data, bytes):
+        upstream_length = header_value(resp_headers, "Content-Length")
+        if upstream_length is not None and not length_dropped:
+            headers["Content-Length"] = upstream_length
+        return Response(data, status=status, content_type=content_type,
+                        headers=headers, direct_passthrough=True)
+    return Response(data, status=status, content_type=content_type, headers=headers)
+
+# ─── Asyncio serving mode ──────────────────────────────────────
+# An event-loop alternative to Flask's thread-per-request dev server: client
+# connections and upstream I/O are all non-blocking, so one process can hold
+# thousands of in-flight requests. Registry, metrics and headers are shared
+# with the Flask path above.
+CLIENT_IDLE_TIMEOUT = 60    # seconds a keep-alive client may sit idle
+MAX_HEADER_LINES    = 100
+PROXY_METHODS       = ("GET", "POST", "PUT", "DELETE")
+
+class AsyncConnectionPool:
+    """Non-blocking counterpart of ConnectionPool for the asyncio engine."""
+
+    def __init__(self, base_url, max_size=POOL_MAX_SIZE, max_idle=POOL_MAX_IDLE,
+                 idle_timeout=POOL_IDLE_TIMEOUT, timeout=UPSTREAM_TIMEOUT):
+        parts = urlsplit(base_url)
+        self.base_url     = base_url
+        self.host         = parts.hostname
+        self.port         = parts.port or 80
+        self.max_size     = max_size
+        self.max_idle     = max_idle
+        self.idle_timeout = idle_timeout
+        self.timeout      = timeout
+        self._idle        = []          # [(reader, writer, last_used)]
+        self._slots       = asyncio.Semaphore(max_size)
+        self.counters     = defaultdict(int)
+
+    async def acquire(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.counters["timeouts"] += 1
+            raise PoolTimeout(f"connection pool for {self.base_url} exhausted")
+        now = time.monotonic()
+        while self._idle:
+            reader, writer, last_used = self._idle.pop()
+            if now - last_used > self.idle_timeout:
+                self.counters["evicted"] += 1
+            elif reader.at_eof() or writer.is_closing():
+                self.counters["stale"] += 1
+            else:
+                self.counters["reused"] += 1
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.counters["created"] += 1
+        return reader, writer, False
+
+    def release(self, reader, writer, reusable=True, stale=False):
+        if stale:
+            self.counters["stale"] += 1
+        if reusable and not reader.at_eof() and len(self._idle) < self.max_idle:
+            self._idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+            self.counters["closed"] += 1
+        self._slots.release()
+
+    def stats(self):
+        return {"busy": self.max_size - self._slots._value, "idle": len(self._idle),
+                "max_size": self.max_size, **self.counters}
+
+async_pools = {}
+
+def get_async_pool(base_url):
+    pool = async_pools.get(base_url)
+    if pool is None:
+        pool = async_pools[base_url] = AsyncConnectionPool(base_url)
+    return pool
+
+async def read_http_headers(reader):
+    headers = []
+    while True:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("connection closed mid-headers")
+        if line in (b"\r\n", b"\n"):
+            return headers
+        if len(headers) >= MAX_HEADER_LINES:
+            raise ValueError("too many header lines")
+        name, _, value = line.decode("latin-1").partition(":")
+        headers.append((name.strip(), value.strip()))
+
+def body_length(headers):
+    """Content-Length of a message, or None if it is chunked/unsized."""
+    fields = {k.lower(): v for k, v in headers}
+    if "chunked" in fields.get("transfer-encoding", "").lower():
+        return None
+    if "content-length" in fields:
+        return int(fields["content-length"])
+    return None
+
+async def iter_http_body(reader, headers, until_eof=False, timeout=None):
+    """Yield a message body in chunks of at most STREAM_CHUNK_SIZE."""
+    async def read(n):
+        return await asyncio.wait_for(reader.read(n), timeout)
+
+    async def read_exact(n):
+        while n:
+            chunk = await read(min(n, STREAM_CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", n)
+            n -= len(chunk)
+            yield chunk
+
+    fields = {k.lower(): v for k, v in headers}
+    if "chunked" in fields.get("transfer-encoding", "").lower():
+        while True:
+            size = int((await asyncio.wait_for(reader.readline(), timeout)).split(b";")[0], 16)
+            if size == 0:
+                await read_http_headers(reader)     # trailers
+                return
+            async for chunk in read_exact(size):
+                yield chunk
+            await reader.readexactly(2)
+    elif "content-length" in fields:
+        async for chunk in read_exact(int(fields["content-length"])):
+            yield chunk
+    elif until_eof:
+        while True:
+            chunk = await read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+async def read_http_body(reader, headers, until_eof=False):
+    return b"".join([chunk async for chunk in iter_http_body(reader, headers, until_eof)])
+
+async def relay_body_async(reader, writer, pool, resp_headers, reusable, trace=None):
+    """Async counterpart of relay_body: stream the upstream body and give
+    the connection back once it has been fully read (or abandoned)."""
+    done, began = False, time.perf_counter()
+    try:
+        async for chunk in iter_http_body(reader, resp_headers, until_eof=True,
+                                          timeout=UPSTREAM_TIMEOUT):
+            yield chunk
+        done = True
+    finally:
+        stage_mark(trace, "transfer", began)
+        pool.release(reader, writer, reusable=reusable and done)
+
+async def _write_request_body(writer, body, chunked):
+    if isinstance(body, (bytes, bytearray)):
+        writer.write(body)
+        return
+    async for chunk in body:
+        writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+        await writer.drain()
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+
+async def _upstream_exchange(pool, method, path, headers, body, content_length, trace=None):
+    replayable = body is None or isinstance(body, (bytes, bytearray))
+    if replayable:
+        content_length = len(body or b"")
+    while True:
+        began = time.perf_counter()
+        reader, writer, reused = await pool.acquire()
+        sent  = stage_mark(trace, "connect", began)
+        try:
+            head = [f"{method} {path} HTTP/1.1", f"Host: {pool.host}:{pool.port}"]
+            head += [f"{k}: {v}" for k, v in headers.items()]
+            head.append(f"Content-Length: {content_length}" if content_length is not None
+                        else "Transfer-Encoding: chunked")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            if body is not None:
+                await _write_request_body(writer, body, content_length is None)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("upstream closed connection")
+            version, status = status_line.decode("latin-1").split(None, 2)[:2]
+            status = int(status)
+            resp_headers = await read_http_headers(reader)
+            received     = stage_mark(trace, "ttfb", sent)
+            fields = {k.lower(): v for k, v in resp_headers}
+            reusable = ("close" not in fields.get("connection", "").lower()
+                        and version != "HTTP/1.0"
+                        and ("content-length" in fields
+                             or "chunked" in fields.get("transfer-encoding", "").lower()))
+            if status in (204, 304) or 100 <= status < 200:
+                data = b""
+            elif should_stream(body_length(resp_headers)):
+                return (relay_body_async(reader, writer, pool, resp_headers, reusable, trace),
+                        status, dict(resp_headers))
+            else:
+                data = await read_http_body(reader, resp_headers, until_eof=True)
+                stage_mark(trace, "transfer", received)
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            pool.release(reader, writer, reusable=False, stale=reused)
+            if reused and replayable:
+                continue
+            raise
+        except BaseException:
+            pool.release(reader, writer, reusable=False)
+            raise
+        pool.release(reader, writer, reusable=reusable)
+        return data, status, dict(resp_headers)
+
+async def async_forward_request(target_url, method, headers, body, content_length=None,
+                                trace=None, deadline=None):
+    """Returns (data, status, headers); data is bytes, or an async iterator
+    of chunks when the upstream body is large enough to stream."""
+    parts = urlsplit(target_url)
+    pool  = get_async_pool(f"{parts.scheme}://{parts.netloc}")
+    path  = parts.path + (f"?{parts.query}" if parts.query else "")
+    req_headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+    try:
+        timeout = time_left(deadline)
+        if timeout <= 0:
+            raise TimeoutError("deadline exceeded")
+        return await asyncio.wait_for(
+            _upstream_exchange(pool, method, path, req_headers, body, content_length, trace),
+            timeout)
+    except TimeoutError as e:
+        return json.dumps({"error": str(e) or "upstream timed out"}).encode(), 504, {}
+    except Exception as e:
+        return json.dumps({"error": str(e) or type(e).__name__}).encode(), 503, {}
+
+async def async_forward_attempt(svc_name, base_url, target, method, headers, body,
+                                content_length=None, trace=None, deadline=None):
+    """Async forward_attempt; a cancelled attempt still releases its instance."""
+    began, status = time.time(), ABANDONED
+    try:
+        data, status, resp_headers = await async_forward_request(
+            base_url + target, method, headers, body, content_length, trace, deadline)
+        return base_url, data, status, resp_headers
+    finally:
+        release_instance(svc_name, base_url, round((time.time() - began) * 1000, 2),
+                         attempt_outcome(status, deadline),
+                         detect_route(target.partition("?")[0])[1])
+
+async def discard_response_async(result):
+    data = result[1]
+    if not isinstance(data, bytes):
+        try:
+            await data.__anext__()
+        except StopAsyncIteration:
+            pass
+        await data.aclose()
+
+async def async_forward_hedged(svc_name, base_url, target, method, headers, delay, tried,
+                               trace=None, deadline=None):
+    traces     = {base_url: {}}
+    primary    = asyncio.ensure_future(async_forward_attempt(
+        svc_name, base_url, target, method, headers, None,
+        trace=traces[base_url], deadline=deadline))
+    winner     = primary
+    done, _    = await asyncio.wait([primary], timeout=delay)
+    backup_url = None
+    if not done and hedge_budgets[svc_name].withdraw():
+        backup_url = get_next_instance(svc_name, exclude=tried)
+    if backup_url is not None:
+        tried.append(backup_url)
+        traces[backup_url] = {}
+        backup  = asyncio.ensure_future(async_forward_attempt(
+            svc_name, backup_url, target, method, headers, None,
+            trace=traces[backup_url], deadline=deadline))
+        pending, winner = {primary, backup}, None
+        while winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = pick_winner(done, pending)
+        loser = backup if winner is primary else primary
+        if loser.done():
+            await discard_response_async(loser.result())
+        else:
+            loser.cancel()
+            hedge_losers.add(loser)
+            loser.add_done_callback(hedge_losers.discard)
+        hedge_stats.inc("losers_cancelled")
+        if winner is backup:
+            hedge_stats.inc("backup_wins")
+    result = await winner
+    if trace is not None:
+        trace.update(traces[result[0]])
+    return result
+
+def _json_response(payload, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(payload).encode()
+
+def is_lb_route(path, method):
+    """True for the LB's own Flask endpoints (everything except proxy)."""
+    try:
+        endpoint, _ = app.url_map.bind("localhost").match(path, method)
+    except HTTPException:
+        return False
+    return endpoint != "proxy"
+
+async def call_flask_view(method, target, headers, body, client_ip):
+    # LB admin endpoints are rare and cheap; run them through the Flask app
+    # on a worker thread so both engines share one implementation.
+    def run():
+        with app.test_client() as client:
+            resp = client.open(target, method=method, headers=headers, data=body,
+                               environ_base={"REMOTE_ADDR": client_ip or ""})
+            return resp.status_code, {"Content-Type": resp.content_type}, resp.get_data()
+    return await asyncio.get_running_loop().run_in_executor(None, run)
+
+async def read_all(data):
+    if data is None or isinstance(data, bytes):
+        return data
+    try:
+        return b"".join([chunk async for chunk in data])
+    finally:
+        await data.aclose()
+
+async def async_batch(headers, body, client_ip):
+    """Async equivalent of the /batch view."""
+    started    = time.perf_counter()
+    req_fields = {k.lower(): v for k, v in headers}
+    request_id = request_id_for(req_fields.get("x-request-id"))
+    try:
+        payload = json.loads(await read_all(body) or b"")
+    except ValueError:
+        payload = None
+    items, error = batch_items(payload, req_fields, request_id)
+    if error:
+        return _json_response({"success": False, "error": error}, 400)
+
+    async def run(item_id, method, target, headers, body):
+        began = time.perf_counter()
+        full_path, _, query = target.partition("?")
+        try:
+            status, resp_headers, data = await async_proxy(
+                method, full_path, query, list(headers.items()), body, None, client_ip)
+            data = await read_all(data)
+        except Exception as e:
+            return batch_error(item_id, 502, str(e) or type(e).__name__)
+        return batch_result(item_id, status, resp_headers, data,
+                            round((time.perf_counter() - began) * 1000, 2))
+
+    results = await asyncio.gather(*(run(*item) for item in items if len(item) == 5))
+    ran     = iter(results)
+    results = [next(ran) if len(item) == 5 else batch_error(*item) for item in items]
+    return batch_response(request_id, results, started, req_fields.get("accept-encoding"))
+
+async def async_dispatch(method, target, headers, body, content_length=None, client_ip=None):
+    """Async equivalent of the Flask routes; returns (status, headers, body)."""
+    full_path, _, query = target.partition("?")
+    if full_path == "/batch" and method == "POST":
+        return await async_batch(headers, body, client_ip)
+    if is_lb_route(full_path, method):
+        return await call_flask_view(method, target, headers, await read_all(body), client_ip)
+    if method not in PROXY_METHODS:
+        return _json_response({"error": f"Method {method} not allowed"}, 405)
+    return await async_proxy(method, full_path, query, headers, body, content_length, client_ip)
+
+async def async_proxy(method, full_path, query, headers, body, content_length, client_ip):
+    req_fields = {k.lower(): v for k, v in headers}
+    request_id = request_id_for(req_fields.get("x-request-id"))
+    stages     = {}
+    began      = time.perf_counter()
+    svc_name, route = detect_route(full_path)
+    stage_mark(stages, "route", began)
+
+    def log(status, outcome, **fields):
+        fields.setdefault("ms", round((time.perf_counter() - began) * 1000, 2))
+        access_log.log(status, outcome=outcome, method=method, path=full_path, query=query,
+                       service=svc_name, client=client_ip, request_id=request_id, **fields)
+
+    if not svc_name:
+        record_unrouted()
+        log(404, "unrouted")
+        return _json_response(not_found_payload(full_path), 404)
+
+    claims, denied = authenticate(req_fields.get("authorization"), route)
+    if denied:
+        data, status, extra = denied
+        log(status, "unauthorized")
+        return status, {"Content-Type": "application/json", **extra}, data
+
+    limited    = rate_limit(client_key(client_ip, claims), route)
+    if limited:
+        data, status, extra = limited
+        log(status, "rate_limited")
+        return status, {"Content-Type": "application/json", **extra}, data
+
+    deadline = request_deadline(route, req_fields.get(DEADLINE_HEADER.lower()))
+    if deadline_exceeded(svc_name, route, deadline, 504):
+        data, status, extra = deadline_response()
+        log(status, "deadline")
+        return status, {"Content-Type": "application/json", **extra}, data
+
+    identity   = request_identity(req_fields.get("authorization"), claims)
+    key        = cache_key(method, full_path, query, identity)
+    cached     = cache_lookup(key, req_fields)
+    if cached:
+        status, content_type, data = cached
+        record_cache_hit(svc_name, route, status)
+        log(status, "cache_hit")
+        data, extra, _ = compress_response(data, status, content_type, {},
+                                           req_fields.get("accept-encoding"))
+        return status, {"Content-Type": content_type, **cached_response_headers(svc_name),
+                        **extra, "X-Request-ID": request_id}, data
+
+    priority = priority_class(full_path, req_fields.get(PRIORITY_HEADER.lower()))
+    exempt   = concurrency_exempt(full_path, claims)
+    start    = time.time()
+
+    target      = full_path + (f"?{query}" if query else "")
+    fwd_headers = upstream_headers(dict(headers), request_id, deadline, claims)
+    hedge_after = hedge_delay(svc_name, route, method, body)
+    routing_key = hash_key(svc_name, full_path, query, req_fields)
+
+    async def call_upstream():
+        tried = []
+        retry_budgets[svc_name].deposit()
+        while True:
+            picking  = time.perf_counter()
+            base_url = await acquire_instance_async(svc_name, tried, routing_key, deadline,
+                                                    exempt)
+            stage_mark(stages, "select", picking)
+            if base_url is None:
+                return (None, *no_instance_response(svc_name))
+            tried.append(base_url)
+            if hedge_after is not None and len(tried) == 1:
+                base_url, data, status, resp_headers = await async_forward_hedged(
+                    svc_name, base_url, target, method, fwd_headers, hedge_after, tried,
+                    stages, deadline)
+            else:
+                base_url, data, status, resp_headers = await async_forward_attempt(
+                    svc_name, base_url, target, method, fwd_headers, body, content_length,
+                    stages, deadline)
+            if (not should_retry(svc_name, method, body, len(tried), status, data)
+                    or time_left(deadline) <= 0):
+                return base_url, data, status, resp_headers
+
+    async def fetch():
+        if not await admission.acquire_async(priority):
+            raise AdmissionShed(priority)
+        try:
+            return await call_upstream()
+        finally:
+            admission.release(priority)
+
+    try:
+        if method == "GET" and body is None:
+            (base_url, data, status, resp_headers), shared = await async_single_flight.do(
+                (svc_name, full_path, query, identity), fetch, deadline)
+        else:
+            (base_url, data, status, resp_headers), shared = await fetch(), False
+    except AdmissionShed:
+        data, status, extra = shed_response(priority)
+        log(status, "shed")
+        return status, {"Content-Type": "application/json", **extra}, data
+    elapsed = round((time.time() - start) * 1000, 2)
+
+    record_result(svc_name, route, elapsed, status)
+    deadline_exceeded(svc_name, route, deadline, status)
+    if method in WRITE_METHODS:
+        response_cache.invalidate_service(svc_name)
+    if not shared:
+        cache_store(key, svc_name, req_fields, status, resp_headers, data)
+
+    request_traces.record(request_id, method, full_path, svc_name, base_url, status,
+                          elapsed, stages, shared)
+    log(status, "upstream" if base_url else "no_instance", upstream=base_url, ms=elapsed,
+        coalesced=shared)
+
+    content_type = header_value(resp_headers, "Content-Type", "application/json")
+    out_headers  = {"Content-Type": content_type}
+    data, extra, length_dropped = compress_response(
+        data, status, content_type, resp_headers, req_fields.get("accept-encoding"))
+    upstream_length = header_value(resp_headers, "Content-Length")
+    if not isinstance(data, bytes) and upstream_length is not None and not length_dropped:
+        out_headers["Content-Length"] = upstream_length
+    out_headers.update(extra)
+    out_headers.update(lb_headers(svc_name, elapsed))
+    out_headers.update(trace_headers(request_id, stages, elapsed))
+    if key is not None:
+        out_headers["X-Cache"] = "MISS"
+    if shared:
+        out_headers["X-Coalesced"] = "1"
+    return status, out_headers, data
+
+async def write_async_response(writer, status, resp_headers, data, keep_alive):
+    reason  = http.client.responses.get(status, "")
+    head    = [f"HTTP/1.1 {status} {reason}"]
+    head   += [f"{k}: {v}" for k, v in resp_headers.items()]
+    chunked = False
+    if isinstance(data, bytes):
+        head.append(f"Content-Length: {len(data)}")
+    elif "Content-Length" not in resp_headers:
+        head.append("Transfer-Encoding: chunked")
+        chunked = True
+    head.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    if isinstance(data, bytes):
+        writer.write(data)
+        await writer.drain()
+        return
+    try:
+        async for chunk in data:
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            await writer.drain()
+    finally:
+        await data.aclose()
+    if chunked:
+        writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+async def handle_async_client(reader, writer):
+    client_ip = (writer.get_extra_info("peername") or ("",))[0]
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), CLIENT_IDLE_TIMEOUT)
+            if not line.strip():
+                break
+            method, target, version = line.decode("latin-1").split()
+            headers  = await read_http_headers(reader)
+            length   = body_length(headers)
+            chunked  = "chunked" in {k.lower(): v for k, v in headers}.get(
+                "transfer-encoding", "").lower()
+            streamed = chunked or (length is not None and should_stream(length))
+            if streamed:
+                body = iter_http_body(reader, headers)
+            else:
+                body = await read_http_body(reader, headers) or None
+            conn_hdr = {k.lower(): v for k, v in headers}.get("connection", "").lower()
+            keep_alive = ("keep-alive" in conn_hdr if version == "HTTP/1.0"
+                          else "close" not in conn_hdr)
+
+            try:
+                status, resp_headers, data = await async_dispatch(
+                    method, target, headers, body, length, client_ip)
+            finally:
+                if streamed:
+                    # Whatever the upstream did not consume is still on the
+                    # client socket, so this connection cannot carry another
+                    # request unless the body was read to the end.
+                    try:
+                        await body.__anext__()
+                        keep_alive = False
+                    except StopAsyncIteration:
+                        pass
+                    await body.aclose()
+            await write_async_response(writer, status, resp_headers, data, keep_alive)
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+async def serve_async(host="localhost", port=5000, reuse_port=False):
+    server = await asyncio.start_server(handle_async_client, host, port, backlog=1024,
+                                        reuse_port=reuse_port or None)
+    async with server:
+        await server.serve_forever()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chama load balancer")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="serve with the asyncio engine instead of Flask")
+    parser.add_argument("--registry-file", metavar="PATH",
+                        help="JSON service registry to load and watch for changes")
+    parser.add_argument("--access-log", metavar="PATH", default=ACCESS_LOG_PATH,
+                        help="JSON-lines access log file ('' disables it)")
+    parser.add_argument("--access-log-sample", metavar="RATE", type=float,
+                        default=ACCESS_LOG_SAMPLE_RATE,
+                        help="fraction of non-5xx requests to log (default: all)")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="fork N worker processes sharing port 5000 (SO_REUSEPORT)")
+    args = parser.parse_args()
+    access_log.path, access_log.sample_rate = args.access_log, args.access_log_sample
+
     print("=" * 55)
     print("  CHAMA MICROSERVICES LOAD BALANCER")
     print("  Listening on http://localhost:5000")
-    print("  Strategy: Round-Robin")
+    print(f"  Strategy: {DEFAULT_STRATEGY} (default)")
+    print(f"  Engine:   {'asyncio' if args.use_async else 'Flask (threaded)'}")
+    print(f"  Workers:  {args.workers}")
+    print(f"  JWT auth: {'on' if token_verifier is not None else 'off (CHAMA_JWT_SECRET unset)'}")
     print("=" * 55)
     for name, routes in SERVICE_ROUTES.items():
         print(f"  {name:15} → {', '.join(routes)}")
     print("=" * 55)
-    app.run(port=5000, debug=False)
+    if args.workers > 1:
+        run_workers(args.workers, args.use_async, args.registry_file)
+        raise SystemExit(0)
+    start_background_tasks(args.registry_file)
+    if args.use_async:
+        asyncio.run(serve_async(port=5000))
+    else:
+        app.run(port=5000, debug=False)
@@ -0,0 +1,202 @@
+"""Regression tests for load_balancer.py. Run with: python -m pytest -q"""
+import asyncio
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import load_balancer as lb
+
+
+@pytest.fixture
+def hung_service():
+    """A service whose only instance accepts connections and never answers."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    accepted = []
+    def accept():
+        while True:
+            try:
+                accepted.append(listener.accept()[0])
+            except OSError:
+                return
+    threading.Thread(target=accept, daemon=True).start()
+    url = "http://127.0.0.1:%d" % listener.getsockname()[1]
+    lb.SERVICES["hung"] = {"instances": [url], "index": 0, "healthy": [True]}
+    lb.init_balancer_state(lb.SERVICES["hung"])
+    yield "hung", url
+    del lb.SERVICES["hung"]
+    lb.breakers.pop(url, None)
+    lb.limiters.pop(url, None)
+    listener.close()
+    for conn in accepted:
+        conn.close()
+
+
+class BigBodyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive, so the pool reuses the socket
+    body = b"x" * (600 * 1024)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def big_body_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BigBodyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    yield url
+    server.shutdown()
+    server.server_close()
+    lb.pools.pop(url, None)
+
+
+def attempt(svc_name, deadline):
+    base_url = lb.get_next_instance(svc_name)
+    return lb.forward_attempt(svc_name, base_url, "/members/1", "GET", {}, None,
+                              deadline=deadline)[2]
+
+
+def test_route_budget_timeout_counts_as_failure(hung_service, monkeypatch):
+    svc_name, url = hung_service
+    monkeypatch.setitem(lb.ROUTE_TIMEOUTS, "/members", 0.05)
+    for _ in range(lb.BREAKER_FAILURE_THRESHOLD):
+        assert attempt(svc_name, lb.request_deadline("/members")) == 504
+    svc = lb.SERVICES[svc_name]
+    assert svc["failures"][0] == lb.BREAKER_FAILURE_THRESHOLD
+    assert svc["healthy"] == [False]
+    assert lb.get_breaker(url).snapshot()["state"] == lb.CircuitBreaker.OPEN
+
+
+def test_client_deadline_timeout_is_abandoned(hung_service):
+    svc_name, url = hung_service
+    for _ in range(lb.BREAKER_FAILURE_THRESHOLD):
+        client_deadline = int((time.time() + 0.05) * 1000)
+        deadline = lb.request_deadline("/members", client_deadline)
+        assert deadline.by_client
+        assert attempt(svc_name, deadline) == 504
+    svc = lb.SERVICES[svc_name]
+    assert svc["failures"][0] == 0
+    assert svc["healthy"] == [True]
+    assert lb.get_breaker(url).snapshot() == {"state": lb.CircuitBreaker.CLOSED, "failures": 0}
+
+
+def test_abandoned_half_open_trial_is_given_back():
+    breaker = lb.CircuitBreaker()
+    breaker.state, breaker.opened_at = breaker.OPEN, 0.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+
+
+def test_cache_is_per_identity_and_skips_private_authenticated(monkeypatch):
+    monkeypatch.setattr(lb, "response_cache", lb.ResponseCache())
+    path = "/loans/summary"
+    mine = lb.cache_key("GET", path, "", lb.request_identity("Bearer a", {"chama_id": 1}))
+    theirs = lb.cache_key("GET", path, "", lb.request_identity("Bearer b", {"chama_id": 2}))
+    assert mine != theirs
+    auth = {"authorization": "Bearer a"}
+    lb.cache_store(mine, "loan", auth, 200, {"Content-Type": "application/json"}, b"{}")
+    assert lb.cache_lookup(mine, auth) is None
+    lb.cache_store(mine, "loan", auth, 200, {"Cache-Control": "public"}, b"{}")
+    assert lb.cache_lookup(mine, auth) is not None
+    assert lb.cache_lookup(theirs, {"authorization": "Bearer b"}) is None
+
+
+def test_lone_instance_past_its_limit_unless_degrading(hung_service):
+    svc_name, url = hung_service
+    limiter = lb.get_limiter(url)
+    limiter.limit = 1
+    assert lb.get_next_instance(svc_name) == url
+    assert lb.get_next_instance(svc_name) == url        # nowhere else to go
+    limiter.pressure = lb.CONCURRENCY_TOLERANCE + 1
+    assert lb.get_next_instance(svc_name) is None
+    assert lb.acquire_instance(svc_name, exempt=True) == url
+
+
+def test_priority_header_alone_does_not_skip_concurrency_limits(monkeypatch):
+    monkeypatch.setitem(lb.PRIORITY_ROUTES, "/ussd", "critical")
+    monkeypatch.setattr(lb, "CONCURRENCY_EXEMPT_ROLES", {"ussd_gateway"})
+    assert lb.priority_class("/members/1", "ussd") == "critical"
+    assert not lb.concurrency_exempt("/members/1", {})
+    assert lb.concurrency_exempt("/ussd/session", {})
+    assert lb.concurrency_exempt("/members/1", {"role": "ussd_gateway"})
+    assert lb.concurrency_exempt("/members/1", {"role": ["member", "ussd_gateway"]})
+
+
+def test_streamed_bodies_back_to_back_on_one_connection(big_body_url):
+    for _ in range(3):
+        data, status, _ = lb.forward_request_streaming(big_body_url + "/big", "GET", {}, None)
+        assert status == 200
+        assert not isinstance(data, bytes)
+        assert b"".join(data) == BigBodyHandler.body
+    stats = lb.get_pool(big_body_url).stats()
+    assert (stats["created"], stats["reused"]) == (1, 2)
+
+
+def test_unverified_subject_does_not_pick_the_rate_limit_bucket():
+    forged = lb.authenticate("Bearer e30.eyJzdWIiOiAiZm9yZ2VkIn0.x", "/members")[0]
+    assert lb.client_key("10.0.0.7", forged) == "ip:10.0.0.7"
+    assert lb.client_key("10.0.0.7", {"sub": "m-1"}) == "sub:m-1"
+
+
+@pytest.mark.parametrize("config", [
+    ["not", "an", "object"],
+    {"services": {"x": {"routes": "/x", "instances": ["http://127.0.0.1:1"]}}},
+    {"services": {"x": {"routes": ["/"]}}},
+    {"services": {"x": {"routes": ["/x"]}, "member": {"slow_start": "soon"}}},
+    {"services": {"x": {"routes": ["/x"]}, "member": {"instances": "http://127.0.0.1:1"}}},
+])
+def test_bad_registry_config_changes_nothing(config):
+    services, routes = lb.SERVICES, lb.SERVICE_ROUTES
+    with pytest.raises(ValueError):
+        lb.apply_registry_config(config)
+    assert lb.SERVICES is services and lb.SERVICE_ROUTES is routes
+    assert lb.detect_route("/anything/else") == (None, None)
+
+
+def test_exhausted_pool_wait_is_bounded_by_the_deadline():
+    pool = lb.ConnectionPool("http://127.0.0.1:1", max_size=1)
+    pool.acquire()
+    began = time.monotonic()
+    with pytest.raises(TimeoutError):
+        pool.acquire(0.1)
+    assert time.monotonic() - began < 1
+
+
+def test_threaded_hedge_cancels_the_hung_primary(hung_service, big_body_url):
+    svc_name, hung_url = hung_service
+    lb.set_instances(svc_name, [hung_url, big_body_url])
+    deadline = lb.request_deadline("/members")
+    began = time.monotonic()
+    base_url = lb.get_next_instance(svc_name, exclude=[big_body_url])
+    result = lb.forward_hedged(svc_name, base_url, "/members/1", "GET", {}, 0.05, [base_url],
+                               deadline=deadline)
+    assert result[0] == big_body_url and result[2] == 200
+    assert b"".join(result[1]) == BigBodyHandler.body
+    assert time.monotonic() - began < 1
+    assert lb.SERVICES[svc_name]["outstanding"] == [0, 0]
+    assert lb.get_breaker(hung_url).snapshot()["failures"] == 0
+
+
+def test_responses_that_never_reach_an_upstream_are_logged(monkeypatch, tmp_path):
+    log = lb.AccessLog(path=str(tmp_path / "access.log"))
+    monkeypatch.setattr(lb, "access_log", log)
+    assert lb.app.test_client().get("/nowhere?x=1").status_code == 404
+    status = asyncio.run(lb.async_proxy("GET", "/nowhere", "", [], None, None, "10.0.0.7"))[0]
+    assert status == 404
+    records = list(log._buffer)
+    assert [(r["status"], r["outcome"], r["path"]) for r in records] == [
+        (404, "unrouted", "/nowhere"), (404, "unrouted", "/nowhere")]
+    assert records[0]["query"] == "x=1" and records[1]["client"] == "10.0.0.7"